@@ -0,0 +1,36 @@
+# Run the boot benchmark (src/boot_bench.py) against the simulated chip - on the host
+#
+#     python sim/bench_boot.py          # compare with sim/boot_baseline.json
+#     python sim/bench_boot.py save     # store this run as the new baseline
+#
+# Sleeps are on the virtual clock, so the times are the driver's own delays plus the host's time
+# to run the driver code, which varies from run to run - so the slack is wider than on the Pico.
+# Transaction and byte counts are exact, so any change to them shows up.
+# The report is written to sim/boot_report.json. Exits with an error if there is a regression.
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[0:0] = [HERE, os.path.join(ROOT, "src")]
+
+import machine                       # first, so the time functions are in place for the driver
+from cyw43_sim import SimChip
+from gspi import LoopbackTransport
+import boot_bench
+
+
+def main(argv):
+    os.chdir(os.path.join(ROOT, "fw"))
+    chip = SimChip()
+    transport = LoopbackTransport(chip.transaction, chip.interrupt)
+    report, regressions = boot_bench.run(transport, save="save" in argv,
+                                         baseline=os.path.join(HERE, "boot_baseline.json"),
+                                         report_file=os.path.join(HERE, "boot_report.json"),
+                                         slack_us=10_000)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
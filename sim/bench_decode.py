@@ -0,0 +1,26 @@
+# Run the decoding benchmark (src/decode_bench.py) on the host
+#
+#     python sim/bench_decode.py [iterations]
+#
+# CPython can't count allocations the way MicroPython's gc.mem_alloc() does, so only the times are
+# shown - run decode_bench.run() on the Pico for the bytes allocated per event.
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[0:0] = [HERE, os.path.join(ROOT, "src")]
+
+import machine                       # first, so the time functions are in place for the driver
+import decode_bench
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 10_000
+    decode_bench.run(iterations)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
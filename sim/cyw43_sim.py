@@ -0,0 +1,481 @@
+# Register level simulation of the CYW43439, for running cyw.py and ble.py on a host
+#
+# SimChip.transaction(write, read_length) takes one gSPI transaction and returns the bytes read, so
+# it plugs straight into LoopbackTransport (see gspi.py):
+#
+#     chip = SimChip()
+#     cyw = CYW(LoopbackTransport(chip.transaction, chip.interrupt))
+#
+# What is modelled:
+#     gSPI        command word decode, 16 bit word swapped mode until CONFIG_REG sets 32 bit words,
+#                 backplane read padding. Clock modes are not modelled - HIGH_SPEED works the same.
+#     SPI_FUNC    CONFIG, interrupt (write 1 to clear) and interrupt enable, status (F2_RX_READY once
+#                 the WLAN core is running), FEEDBEAD, the test register and the pad register
+#     BACK_FUNC   backplane window, chip clock CSR (ALP at once, HT once the WLAN core is running),
+#                 watermark and pull-up registers, and sparse memory for everything else - RAM, the
+#                 core wrapper registers, the bluetooth firmware area and the BT shared memory
+#     cores       taking the WLAN core out of reset starts the "firmware"
+#     BT          HOST_CONTROL_REG (SW_READY, WAKE_BT, DATA_VALID), BT_CONTROL_REG (BT_AWAKE, and
+#                 FW_READY once bluetooth firmware has been written and the host is ready),
+#                 WLAN_BASE_ADDRESS_REG, SDIO_INT_STATUS (I_HMB_FC_CHANGE, write 1 to clear)
+#     HCI         each DATA_VALID toggle makes the controller take every packet from the H2BT buffer
+#                 and answer with canned events (and ATT responses for ACL data) in the BT2H buffer,
+#                 raising the host interrupt. post() adds events unprompted.
+#
+# Transactions, bytes and the HCI traffic are counted so the simulator can also be used to profile
+# the driver.
+
+BACK_FUNC = 1
+SPI_FUNC  = 0
+
+# SPI function registers
+CONFIG_REG          = 0x00
+SPI_INT_REG         = 0x04
+SPI_INT_ENABLE_REG  = 0x06
+SPI_STATUS_REG      = 0x08
+FEEDBEAD_REG        = 0x14
+TEST_REG            = 0x18
+BACKPLANE_PAD_REG   = 0x1d
+
+WORD_LENGTH_32      = 0x0000_0001
+F1_INTR             = 0x2000
+STATUS_F2_RX_READY  = 0x0000_0020
+FEEDBEAD_VALUE      = 0xfeed_bead
+
+# SDIO core registers on the backplane function
+SDIO_FUNCTION2_WATERMARK = 0x1_0008
+BACKPLANE_LOW_REG        = 0x1_000a
+BACKPLANE_HIGH_REG       = 0x1_000c
+SDIO_CHIP_CLOCK_CSR      = 0x1_000e
+SDIO_PULL_UP             = 0x1_000f
+
+SBSDIO_ALP_AVAIL         = 0x40
+SBSDIO_HT_AVAIL          = 0x80
+
+# Backplane addresses
+CHIPCOMMON_BASE_ADDRESS  = 0x1800_0000
+WLAN_BASE_ADDRESS_REG    = 0x1800_0d68
+HOST_CONTROL_REG         = 0x1800_0d6c
+BT_CONTROL_REG           = 0x1800_0c7c
+SDIO_INT_STATUS          = 0x1800_2020
+SDIO_INT_HOST_MASK       = 0x1800_2024
+WLAN_RESETCTRL           = 0x1810_3800
+SOCSRAM_RESETCTRL        = 0x1810_4800
+BTFW_MEM_OFFSET          = 0x1900_0000
+BTFW_MEM_END             = 0x1a00_0000
+
+CHIP_ID                  = 43439
+
+WAKE_BT                  = 0x0002_0000
+DATA_VALID               = 0x0000_0002
+SW_READY                 = 0x0100_0000
+BT_AWAKE                 = 0x0000_0100
+FW_READY                 = 0x0100_0000
+I_HMB_FC_CHANGE          = 0x20
+
+# BT shared memory - where the simulated bluetooth firmware puts it
+BT_SHARED_BASE           = 0x0007_0000
+H2BT_BUFFER              = 0x0000
+BT2H_BUFFER              = 0x1000
+SEND_HEAD                = 0x2000
+SEND_TAIL                = 0x2004
+RECEIVE_HEAD             = 0x2008
+RECEIVE_TAIL             = 0x200c
+RING_SIZE                = 0x1000
+RING_MASK                = RING_SIZE - 1
+
+PAGE_SIZE                = 0x1000
+
+# HCI
+HCI_COMMAND_PKT = 0x01
+HCI_ACLDATA_PKT = 0x02
+HCI_EVENT_PKT   = 0x04
+
+CONNECTION_HANDLE = 0x0040
+SIM_ADDRESS       = bytes([0x51, 0x84, 0x41, 0xdd, 0x3a, 0xd8])         # D8:3A:DD:41:84:51, little endian
+PEER_ADDRESS      = bytes([0x47, 0x84, 0x41, 0xdd, 0x3a, 0xd8])         # D8:3A:DD:41:84:47
+
+# Return parameters for Command Complete, after the status
+RETURN_PARAMETERS = {
+    0x1001: bytes([0x0b, 0x00, 0x00, 0x0b, 0x31, 0x01, 0x00, 0x00]),    # Read Local Version Information
+    0x1003: bytes(8),                                                   # Read Local Supported Features
+    0x1005: bytes([0xfd, 0x03, 0x40, 0x08, 0x00, 0x00, 0x00]),          # Read Buffer Size
+    0x1009: SIM_ADDRESS,                                                # Read BD_ADDR
+    0x2002: bytes([0xfb, 0x00, 0x08]),                                  # LE Read Buffer Size - 251 bytes, 8 packets
+    0x2003: bytes([0x01, 0, 0, 0, 0, 0, 0, 0]),                         # LE Read Local Supported Features
+}
+
+# Commands answered with Command Status, and the event that follows
+STATUS_COMMANDS = (0x0406, 0x200d, 0x2016)
+
+ADVERTISING_DATA = bytes.fromhex('020106' + '0a0953696d446576696365')  # flags, name "SimDevice"
+
+
+def u16(buf, ind):
+    return buf[ind] | (buf[ind + 1] << 8)
+
+def u32(buf, ind):
+    return buf[ind] | (buf[ind + 1] << 8) | (buf[ind + 2] << 16) | (buf[ind + 3] << 24)
+
+def le(val, length):
+    return bytes((val >> (8 * i)) & 0xff for i in range(0, length))
+
+def swap_words(dat):
+    out = bytearray(dat)
+    for i in range(0, len(out) - 1, 2):
+        out[i], out[i + 1] = out[i + 1], out[i]
+    return bytes(out)
+
+
+def event(code, params):
+    return bytes([HCI_EVENT_PKT, code, len(params)]) + params
+
+def command_complete(opcode, params, credits=1):
+    return event(0x0e, bytes([credits]) + le(opcode, 2) + params)
+
+def command_status(opcode, status=0, credits=1):
+    return event(0x0f, bytes([status, credits]) + le(opcode, 2))
+
+def le_meta(subevent, params):
+    return event(0x3e, bytes([subevent]) + params)
+
+def acl(handle, payload, cid=0x0004):
+    return (bytes([HCI_ACLDATA_PKT]) + le(handle | 0x2000, 2) + le(len(payload) + 4, 2) +
+            le(len(payload), 2) + le(cid, 2) + payload)
+
+
+class SimChip:
+    def __init__(self, bt_base=BT_SHARED_BASE):
+        self.bt_base = bt_base
+        self.pages = {}
+
+        # gSPI
+        self.swapped = True                  # the chip starts with 16 bit words
+        self.config = 0
+        self.spi_int = 0
+        self.spi_int_enable = 0
+        self.test_reg = 0
+        self.pad = 4
+
+        # Backplane
+        self.window = 0
+        self.csr = 0
+        self.watermark = 0
+        self.pull_up = 0
+        self.sdio_int_status = 0
+        self.host_control = 0
+        self.wlan_running = False
+        self.bt_fw_bytes = 0
+
+        self.write_mem(CHIPCOMMON_BASE_ADDRESS, le(CHIP_ID, 4))
+        self.write_mem(WLAN_RESETCTRL, le(1, 4))
+        self.write_mem(SOCSRAM_RESETCTRL, le(1, 4))
+
+        # HCI
+        self.pending = []
+        self.commands = []
+        self.command_credits = 1             # Num_HCI_Command_Packets in the command events
+        self.acl_in = 0
+        self.acl_partial = {}                # L2CAP PDUs being reassembled, by handle
+        self.acl_pdus = []
+        self.events_out = 0
+        self.scanning = False
+
+        # Statistics
+        self.transactions = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.core_resets = 0
+        self.doorbells = 0
+
+    # Sparse backplane memory
+
+    def read_mem(self, addr, length):
+        out = bytearray(length)
+        ind = 0
+        while ind < length:
+            page = self.pages.get((addr + ind) // PAGE_SIZE)
+            offset = (addr + ind) % PAGE_SIZE
+            count = min(length - ind, PAGE_SIZE - offset)
+            if page:
+                out[ind:ind + count] = page[offset:offset + count]
+            ind += count
+        return out
+
+    def write_mem(self, addr, data):
+        ind = 0
+        length = len(data)
+        while ind < length:
+            number = (addr + ind) // PAGE_SIZE
+            page = self.pages.get(number)
+            if page is None:
+                page = bytearray(PAGE_SIZE)
+                self.pages[number] = page
+            offset = (addr + ind) % PAGE_SIZE
+            count = min(length - ind, PAGE_SIZE - offset)
+            page[offset:offset + count] = data[ind:ind + count]
+            ind += count
+
+    def read_u32(self, addr):
+        return u32(self.read_mem(addr, 4), 0)
+
+    def write_u32(self, addr, val):
+        self.write_mem(addr, le(val, 4))
+
+    # The interrupt line - BT2H data waiting, passed to the host through F1_INTR
+
+    def bt_interrupt(self):
+        mask = self.read_u32(SDIO_INT_HOST_MASK)
+        return self.sdio_int_status & mask & I_HMB_FC_CHANGE != 0
+
+    def interrupt(self):
+        return self.spi_int_enable & F1_INTR != 0 and self.bt_interrupt()
+
+    # gSPI transactions
+
+    def transaction(self, write, read_length):
+        self.transactions += 1
+        if len(write) < 4:
+            return bytes(read_length)
+        cmd_bytes = write[0:4]
+        if self.swapped:
+            cmd_bytes = swap_words(cmd_bytes)
+        cmd = u32(cmd_bytes, 0)
+        wr   = (cmd >> 31) & 1
+        fn   = (cmd >> 28) & 3
+        addr = (cmd >> 11) & 0x1_ffff
+        size = cmd & 0x3ff
+
+        if wr:
+            data = write[4:4 + size]
+            if self.swapped:
+                data = swap_words(data)
+            self.bytes_written += len(data)
+            if fn == SPI_FUNC:
+                self.spi_write(addr, data)
+            elif fn == BACK_FUNC:
+                self.backplane_write(addr, data)
+            return bytes(read_length)
+
+        if fn == SPI_FUNC:
+            data = self.spi_read(addr, size)
+        elif fn == BACK_FUNC:
+            data = bytes(self.pad) + self.backplane_read(addr, size)
+        else:
+            data = b''
+        self.bytes_read += size
+        data = (data + bytes(read_length))[0:read_length]
+        return swap_words(data) if self.swapped else data
+
+    # SPI function registers
+
+    def spi_regs(self):
+        regs = bytearray(0x20)
+        regs[0x00:0x04] = le(self.config, 4)
+        regs[0x04:0x06] = le(self.spi_int | (F1_INTR if self.bt_interrupt() else 0), 2)
+        regs[0x06:0x08] = le(self.spi_int_enable, 2)
+        regs[0x08:0x0c] = le(STATUS_F2_RX_READY if self.wlan_running else 0, 4)
+        regs[0x14:0x18] = le(FEEDBEAD_VALUE, 4)
+        regs[0x18:0x1c] = le(self.test_reg, 4)
+        regs[0x1d] = self.pad
+        return regs
+
+    def spi_read(self, addr, size):
+        return bytes(self.spi_regs()[addr:addr + size])
+
+    def spi_write(self, addr, data):
+        regs = self.spi_regs()
+        regs[addr:addr + len(data)] = data
+        end = addr + len(data)
+        if addr <= CONFIG_REG < end:
+            self.config = u32(regs, CONFIG_REG)
+            self.swapped = self.config & WORD_LENGTH_32 == 0
+        if addr <= SPI_INT_REG < end:
+            self.spi_int &= ~u16(regs, SPI_INT_REG)
+        if addr <= SPI_INT_ENABLE_REG < end:
+            self.spi_int_enable = u16(regs, SPI_INT_ENABLE_REG)
+        if addr <= TEST_REG < end:
+            self.test_reg = u32(regs, TEST_REG)
+        if addr <= BACKPLANE_PAD_REG < end:
+            self.pad = regs[BACKPLANE_PAD_REG]
+
+    # Backplane function
+
+    def sdio_regs(self):
+        regs = bytearray(16)
+        regs[0x08] = self.watermark
+        regs[0x0a:0x0d] = le(self.window >> 8, 3)
+        regs[0x0e] = self.csr | SBSDIO_ALP_AVAIL | (SBSDIO_HT_AVAIL if self.wlan_running else 0)
+        regs[0x0f] = self.pull_up
+        return regs
+
+    def backplane_read(self, addr, size):
+        if addr >= 0x1_0000:
+            offset = addr - 0x1_0000
+            return bytes(self.sdio_regs()[offset:offset + size])
+        addr = self.window | (addr & 0x7fff)
+        if addr == BT_CONTROL_REG:
+            return le(self.bt_control(), size)
+        if addr == WLAN_BASE_ADDRESS_REG:
+            return le(self.bt_base if self.bt_control() & FW_READY else 0, size)
+        if addr == SDIO_INT_STATUS:
+            return le(self.sdio_int_status, size)
+        if addr == HOST_CONTROL_REG:
+            return le(self.host_control, size)
+        return bytes(self.read_mem(addr, size))
+
+    def backplane_write(self, addr, data):
+        if addr >= 0x1_0000:
+            regs = self.sdio_regs()
+            offset = addr - 0x1_0000
+            regs[offset:offset + len(data)] = data
+            self.watermark = regs[0x08]
+            self.window = (regs[0x0a] | (regs[0x0b] << 8) | (regs[0x0c] << 16)) << 8
+            self.csr = regs[0x0e] & ~(SBSDIO_ALP_AVAIL | SBSDIO_HT_AVAIL)
+            self.pull_up = regs[0x0f]
+            return
+
+        addr = self.window | (addr & 0x7fff)
+        val = u32(data + bytes(4), 0)
+        if addr == SDIO_INT_STATUS:
+            self.sdio_int_status &= ~val
+            return
+        if addr == HOST_CONTROL_REG:
+            self.write_host_control(val)
+            return
+        self.write_mem(addr, data)
+        if BTFW_MEM_OFFSET <= addr < BTFW_MEM_END:
+            self.bt_fw_bytes += len(data)
+        elif addr == WLAN_RESETCTRL or addr == SOCSRAM_RESETCTRL:
+            self.core_resets += 1
+            if addr == WLAN_RESETCTRL and val & 1 == 0:
+                self.wlan_running = True
+        elif addr == self.bt_base + RECEIVE_TAIL:
+            self.deliver()
+
+    # Bluetooth
+
+    def bt_control(self):
+        val = 0
+        if self.host_control & WAKE_BT:
+            val |= BT_AWAKE
+        if self.bt_fw_bytes > 0 and self.host_control & SW_READY:
+            val |= FW_READY
+        return val
+
+    def write_host_control(self, val):
+        toggled = (val ^ self.host_control) & DATA_VALID
+        self.host_control = val
+        if toggled:
+            self.doorbells += 1
+            self.receive_h2bt()
+
+    def ring_read(self, ring, offset, length):
+        out = bytearray(length)
+        for i in range(0, length):
+            out[i] = self.read_mem(ring + ((offset + i) & RING_MASK), 1)[0]
+        return out
+
+    def receive_h2bt(self):
+        base = self.bt_base
+        head = self.read_u32(base + SEND_HEAD)
+        tail = self.read_u32(base + SEND_TAIL)
+        while tail != head:
+            header = self.ring_read(base + H2BT_BUFFER, tail, 3)
+            length = header[0] | (header[1] << 8) | (header[2] << 16)
+            packet = self.ring_read(base + H2BT_BUFFER, tail + 3, length + 1)
+            tail = (tail + ((3 + length + 1 + 3) & ~3)) & RING_MASK
+            self.on_packet(bytes(packet))
+        self.write_u32(base + SEND_TAIL, tail)
+        self.deliver()
+
+    # Queue a packet for the host, and put as many queued packets in the BT2H buffer as will fit
+    def post(self, packet):
+        self.pending.append(packet)
+        self.deliver()
+
+    def deliver(self):
+        base = self.bt_base
+        head = self.read_u32(base + RECEIVE_HEAD)
+        tail = self.read_u32(base + RECEIVE_TAIL)
+        delivered = False
+        while self.pending:
+            packet = self.pending[0]
+            record = le(len(packet) - 1, 3) + packet
+            record += bytes((-len(record)) & 3)
+            if RING_SIZE - 4 - ((head - tail) & RING_MASK) < len(record):
+                break
+            for i in range(0, len(record)):
+                self.write_mem(base + BT2H_BUFFER + ((head + i) & RING_MASK), record[i:i + 1])
+            head = (head + len(record)) & RING_MASK
+            self.pending.pop(0)
+            self.events_out += 1
+            delivered = True
+        if delivered:
+            self.write_u32(base + RECEIVE_HEAD, head)
+            self.sdio_int_status |= I_HMB_FC_CHANGE
+
+    # HCI controller - canned answers
+
+    def on_packet(self, packet):
+        if packet[0] == HCI_COMMAND_PKT:
+            opcode = u16(packet, 1)
+            self.on_command(opcode, packet[4:4 + packet[3]])
+        elif packet[0] == HCI_ACLDATA_PKT:
+            self.acl_in += 1
+            handle = u16(packet, 1) & 0x0fff
+            self.post(event(0x13, bytes([1]) + le(handle, 2) + le(1, 2)))
+            fragment = packet[5:5 + u16(packet, 3)]
+            if u16(packet, 1) & 0x3000 == 0x1000:               # continuation
+                if handle not in self.acl_partial:
+                    return
+                self.acl_partial[handle] += fragment
+            else:
+                self.acl_partial[handle] = fragment
+            pdu = self.acl_partial[handle]
+            if len(pdu) >= 4 and len(pdu) - 4 >= u16(pdu, 0):
+                del self.acl_partial[handle]
+                self.acl_pdus.append(pdu)
+                if u16(pdu, 2) == 0x0004:
+                    self.on_att(handle, pdu[4:])
+
+    def on_command(self, opcode, params):
+        self.commands.append(opcode)
+        if opcode in STATUS_COMMANDS:
+            self.post(command_status(opcode, 0, self.command_credits))
+            if opcode == 0x200d:                                 # LE Create Connection
+                peer = bytes(params[6:12])
+                self.post(le_meta(0x01, bytes([0]) + le(CONNECTION_HANDLE, 2) + bytes([0, params[5]]) +
+                                  peer + le(0x0018, 2) + le(0, 2) + le(0x0048, 2) + bytes([0])))
+            elif opcode == 0x2016:                               # LE Read Remote Features
+                self.post(le_meta(0x04, bytes([0]) + le(u16(params, 0), 2) + bytes([0x01, 0, 0, 0, 0, 0, 0, 0])))
+            elif opcode == 0x0406:                               # Disconnect
+                self.post(event(0x05, bytes([0]) + le(u16(params, 0), 2) + bytes([0x16])))
+            return
+
+        self.post(command_complete(opcode, bytes([0]) + RETURN_PARAMETERS.get(opcode, b''), self.command_credits))
+        if opcode == 0x200c:                                     # LE Set Scan Enable
+            self.scanning = params[0] == 1
+            if self.scanning:
+                self.advertise()
+
+    # One advertising report from a simulated peripheral
+    def advertise(self, rssi=0xc8):
+        report = bytes([1, 0x00, 0x00]) + PEER_ADDRESS + bytes([len(ADVERTISING_DATA)]) + ADVERTISING_DATA + bytes([rssi])
+        self.post(le_meta(0x02, report))
+
+    def on_att(self, handle, att):
+        opcode = att[0]
+        if opcode == 0x02:                                       # Exchange MTU
+            payload = bytes([0x03]) + le(247, 2)
+        elif opcode == 0x0a:                                     # Read
+            payload = bytes([0x0b]) + b'SimDevice'
+        else:                                                    # Attribute Not Found
+            payload = bytes([0x01, opcode]) + le(u16(att, 1) if len(att) > 2 else 0, 2) + bytes([0x0a])
+        self.post(acl(handle, payload))
+
+    def stats(self):
+        return {"transactions": self.transactions, "bytes_written": self.bytes_written,
+                "bytes_read": self.bytes_read, "core_resets": self.core_resets,
+                "doorbells": self.doorbells, "hci_commands": len(self.commands),
+                "acl_in": self.acl_in, "events_out": self.events_out}
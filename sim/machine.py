@@ -0,0 +1,104 @@
+# Stand-in for the MicroPython machine module, so cyw.py, gspi.py and ble.py run on a host
+#
+# Pins just hold a level, and SoftSPI does nothing - use LoopbackTransport with the simulated chip
+# in cyw43_sim.py for the bus.
+#
+# This module is always the first hardware import, so it also adds the MicroPython time functions
+# to the time module if they are missing (as on CPython). Sleeps do not wait - they move a virtual
+# clock on, so a boot with its long settling delays runs quickly but ticks_ms() and ticks_us() still
+# show the time the delays would have taken.
+
+import time
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX    = TICKS_PERIOD - 1
+TICKS_HALF   = TICKS_PERIOD // 2
+
+_start = time.perf_counter()
+_slept_us = 0
+
+def _now_us():
+    return int((time.perf_counter() - _start) * 1_000_000) + _slept_us
+
+def ticks_us():
+    return _now_us() & TICKS_MAX
+
+def ticks_ms():
+    return (_now_us() // 1000) & TICKS_MAX
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+def sleep_us(us):
+    global _slept_us
+    _slept_us += int(us)
+
+def sleep_ms(ms):
+    sleep_us(ms * 1000)
+
+def sleep(s):
+    sleep_us(s * 1_000_000)
+
+if not hasattr(time, "sleep_ms"):
+    time.ticks_us   = ticks_us
+    time.ticks_ms   = ticks_ms
+    time.ticks_diff = ticks_diff
+    time.ticks_add  = ticks_add
+    time.sleep_us   = sleep_us
+    time.sleep_ms   = sleep_ms
+    time.sleep      = sleep
+
+
+class Pin:
+    IN          = 0
+    OUT         = 1
+    OPEN_DRAIN  = 2
+    PULL_UP     = 1
+    PULL_DOWN   = 2
+    IRQ_FALLING = 4
+    IRQ_RISING  = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.level = 0
+        self.handler = None
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if value is not None:
+            self.level = value
+
+    def value(self, value=None):
+        if value is None:
+            return self.level
+        self.level = 1 if value else 0
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def on(self):
+        self.level = 1
+
+    def off(self):
+        self.level = 0
+
+    def irq(self, handler=None, trigger=IRQ_RISING, hard=False):
+        self.handler = handler
+
+
+class SoftSPI:
+    def __init__(self, baudrate=500_000, polarity=0, phase=0, sck=None, mosi=None, miso=None):
+        pass
+
+    def write(self, buf):
+        pass
+
+    def read(self, length):
+        return bytes(length)
+
+    def readinto(self, buf):
+        for i in range(0, len(buf)):
+            buf[i] = 0
@@ -0,0 +1,23 @@
+# Stand-in for the MicroPython rp2 module
+#
+# Enough for gspi.py to define its PIO programs on a host. There is no PIO, so PIOTransport cannot
+# be started - use LoopbackTransport with the simulated chip in cyw43_sim.py.
+
+class PIO:
+    OUT_LOW    = 0
+    OUT_HIGH   = 1
+    IN_LOW     = 0
+    IN_HIGH    = 1
+    SHIFT_LEFT  = 0
+    SHIFT_RIGHT = 1
+
+
+def asm_pio(**kwargs):
+    def program(function):
+        return function
+    return program
+
+
+class StateMachine:
+    def __init__(self, id, *args, **kwargs):
+        raise OSError("no PIO state machines in the simulator")
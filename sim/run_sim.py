@@ -0,0 +1,96 @@
+# Boot the driver against the simulated CYW43439 and run an HCI exchange - on the host
+#
+#     python sim/run_sim.py [irq] [verbose]
+#
+# Uses the firmware files in fw/. Prints the usual driver output, then the bus and HCI statistics,
+# and exits with an error if the exchange did not go as expected, so it can be used as a regression
+# check.
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[0:0] = [HERE, os.path.join(ROOT, "src")]
+
+import machine                       # first, so the time functions are in place for the driver
+from cyw43_sim import SimChip, CONNECTION_HANDLE
+from gspi import LoopbackTransport
+from ble import BluetoothLEConnection, LE_PUBLIC_ADDRESS
+from cyw import shadow_stats
+import log
+
+
+def run(chip, irq=False):
+    transport = LoopbackTransport(chip.transaction, chip.interrupt)
+    ble = BluetoothLEConnection(0, transport, irq=irq)
+    boot_transactions = chip.transactions
+
+    ble.send_command(0x0c03, b'')                                # Reset
+    ble.do_set_scan_parameters()
+    ble.do_set_scan(True, False)
+    ble.wait_listen(1)
+    ble.do_set_scan(False, False)
+    ble.do_create_connection('D8:3A:DD:41:84:47', LE_PUBLIC_ADDRESS)
+    ble.wait_listen(1)
+    ble.do_att_exchange_mtu_req()
+    ble.wait_listen(1)
+    ble.do_att_read_req(0x0009)
+    ble.wait_listen(1)
+
+    # Once everything is drained, waiting on the interrupt must not touch the bus
+    idle_transactions = None
+    if irq:
+        while ble.readable():
+            ble.receive_all()
+        start = chip.transactions
+        for i in range(0, 100):
+            ble.readable()
+        idle_transactions = chip.transactions - start
+
+    failures = []
+    if idle_transactions:
+        failures.append("{} bus transactions while idle".format(idle_transactions))
+    if transport.selected_irqs:
+        failures.append("{} interrupts taken while CS was low".format(transport.selected_irqs))
+    if ble.handle != CONNECTION_HANDLE:
+        failures.append("no connection")
+    if 0x0c03 not in chip.commands:
+        failures.append("HCI Reset not received")
+    if ble.acl_buffer_length != 251:
+        failures.append("LE Read Buffer Size not handled")
+    if ble.acl_in_flight or ble.acl_queue:
+        failures.append("ACL packets not completed")
+    if ble.acl_pdus != 2 or ble.acl_errors:
+        failures.append("{} ACL PDUs received, {} errors".format(ble.acl_pdus, ble.acl_errors))
+    if chip.acl_in != 2:
+        failures.append("{} ACL packets received, expected 2".format(chip.acl_in))
+    if chip.pending:
+        failures.append("{} events not delivered".format(len(chip.pending)))
+    return ble, boot_transactions, failures
+
+
+def main(argv):
+    os.chdir(os.path.join(ROOT, "fw"))
+    if "verbose" in argv:
+        log.verbose()
+    chip = SimChip()
+    ble, boot_transactions, failures = run(chip, "irq" in argv)
+
+    print()
+    print("Boot transactions:", boot_transactions)
+    for name, value in chip.stats().items():
+        print("{:16} {}".format(name, value))
+    for name, value in ble.user_socket.ring_stats().items():
+        print("{:16} {}".format(name, value))
+    for name, value in ble.acl_stats().items():
+        print("{:16} {}".format(name, value))
+    for name, value in shadow_stats().items():
+        print("{:16} {}".format("shadow_" + name, value))
+    for failure in failures:
+        print("FAIL:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -10,7 +10,9 @@
 #
 
 from time import sleep
+from struct import unpack_from, pack_into, calcsize
 from cyw import *
+from log import *
 #from hci_uart import *
 
 ### constants
@@ -18,6 +20,10 @@ from cyw import *
 COMMAND_TIMEOUT = 1
 DATA_TIMEOUT = 10
 
+# Until LE Read Buffer Size answers - the smallest the specification allows
+ACL_DEFAULT_LENGTH = 27
+ACL_DEFAULT_BUFFERS = 1
+
 #gap_adv_type =  ['ADV_IND', 'ADV_DIRECT_IND', 'ADV_SCAN_IND', 'ADV_NONCONN_IND', 'SCAN_RSP']
 #gap_addr_type = ['PUBLIC', 'RANDOM']
 
@@ -32,9 +38,37 @@ HCI_EVENT_PKT = 0x04
 
 ATT_CID = 0x0004
 
+# ACL packet boundary flags
+ACL_PB_FIRST        = 0x00         # first fragment of an L2CAP PDU, host to controller
+ACL_PB_CONTINUATION = 0x01
+
 SCAN_TYPE_ACTIVE  = 0x01
 FILTER_POLICY_NO_WHITELIST = 0x00
 
+# Event codes for subscribe() - LE meta events are EVT_LE_META << 8 | subevent code
+EVT_DISCONNECTION_COMPLETE           = 0x05
+EVT_COMMAND_COMPLETE                 = 0x0e
+EVT_COMMAND_STATUS                   = 0x0f
+EVT_NUMBER_OF_COMPLETED_PACKETS      = 0x13
+EVT_LE_META                          = 0x3e
+EVT_LE_CONNECTION_COMPLETE           = 0x3e01
+EVT_LE_ADVERTISING_REPORT            = 0x3e02
+EVT_LE_CONNECTION_UPDATE_COMPLETE    = 0x3e03
+EVT_LE_READ_REMOTE_FEATURES_COMPLETE = 0x3e04
+
+# Logged with the status of their Command Complete
+COMMAND_NAMES = {
+    0x0c03: "Reset",
+    0x1005: "Read Buffer Size",
+    0x2002: "LE Read Buffer Size",
+    0x2006: "LE Advertising Parameters Set",
+    0x2008: "LE Advertising Data Set",
+    0x2009: "LE Scan Response Data Set",
+    0x200a: "LE Advertise Enable Set",
+    0x200b: "LE Scan Parameters Set",
+    0x200c: "LE Scan Enable Set",
+}
+
 cmd_text = "\n<< Command:"
 att_text = "\n<< LE Command: "
 
@@ -81,6 +115,34 @@ def to_bits_u16 (byts, ind, start, num_bits):
     mask = (1 << num_bits) - 1
     return val & mask
 
+################################################################
+#
+# In place decoding
+#
+# Fields are read straight out of the received packet with unpack_from and memoryview slices,
+# so nothing is copied. Addresses stay as 48 bit ints until addr_str() is asked for the text
+#
+################################################################
+
+def to_addr_int(byts, ind):
+    low, high = unpack_from("<IH", byts, ind)
+    return high << 32 | low
+
+def addr_str(addr):
+    return ':'.join('{:02x}'.format((addr >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0))
+
+# The reports in an LE Advertising Report event, one at a time, as
+#     (event_type, address_type, address, data, rssi)
+# with the address as an int and the data a memoryview of the event
+def le_advertising_reports(data):
+    mv = memoryview(data)
+    offset = 5
+    for rep in range(0, data[4]):
+        data_len = data[offset + 8]
+        end = offset + 9 + data_len
+        yield data[offset], data[offset + 1], to_addr_int(data, offset + 2), mv[offset + 9: end], data[end]
+        offset = end + 1
+
 #def reverse_addr(byts) :
 #    return bytes(reversed(byts))
 
@@ -113,12 +175,123 @@ def make_acl(handle, length):
     header += from_u16(ATT_CID)    # channel for ATT - 4 for BLE
     return header
 
+def make_acl_fragment(handle, pb, length):
+    header =  from_u8 (0x02)                 # hci command prefix for ACL
+    header += from_u16(handle | (pb << 12))  # hci handle and packet boundary flag
+    header += from_u16(length)               # hci packet length
+    return header
+
 def make_cmd(cmd, length):
     header =  from_u8 (0x01)       # hci command prefix
     header += from_u16(cmd)        # hci command
     header += from_u8 (length)     # hci packet length
     return header
 
+################################################################
+#
+# Command and ACL templates
+#
+# Built once with the header in place, then each send packs its fields with pack_into into the
+# same buffer - no intermediate objects. The buffer is reused, so anything that holds on to a packet
+# past the send (a command or ACL packet waiting for a credit) keeps a copy
+#
+################################################################
+
+def addr_to_int(addr):
+    if isinstance(addr, int):
+        return addr
+    return int(addr.replace(':', ''), 16)
+
+class CommandTemplate:
+
+    def __init__(self, opcode, fmt):
+        self.opcode = opcode
+        self.fmt = "<" + fmt
+        length = calcsize(self.fmt)
+        self.buf = bytearray(4 + length)
+        pack_into("<BHB", self.buf, 0, HCI_COMMAND_PKT, opcode, length)
+
+    def pack(self, *fields):
+        pack_into(self.fmt, self.buf, 4, *fields)
+        return self.buf
+
+# An ATT PDU in one ACL packet - the connection handle is packed with the fields
+class ACLTemplate:
+
+    def __init__(self, att_opcode, fmt):
+        self.fmt = "<" + fmt
+        self.size = 1 + calcsize(self.fmt)                     # the ATT PDU
+        self.buf = bytearray(9 + self.size)
+        pack_into("<BHHHHB", self.buf, 0, HCI_ACLDATA_PKT, 0, self.size + 4, self.size, ATT_CID, att_opcode)
+
+    def pack(self, handle, *fields):
+        pack_into("<H", self.buf, 1, handle | (ACL_PB_FIRST << 12))
+        pack_into(self.fmt, self.buf, 10, *fields)
+        return self.buf
+
+# Addresses are packed as two fields, the low 32 bits then the high 16 - "IH"
+READ_BUFFER_SIZE              = CommandTemplate(0x1005, "")
+LE_READ_BUFFER_SIZE           = CommandTemplate(0x2002, "")
+LE_SET_ADVERTISING_PARAMETERS = CommandTemplate(0x2006, "HHBBBIHBB")
+LE_SET_ADVERTISING_DATA       = CommandTemplate(0x2008, "B31s")
+LE_SET_SCAN_RESPONSE_DATA     = CommandTemplate(0x2009, "B31s")
+LE_SET_ADVERTISE_ENABLE       = CommandTemplate(0x200a, "B")
+LE_SET_SCAN_PARAMETERS        = CommandTemplate(0x200b, "BHHBB")
+LE_SET_SCAN_ENABLE            = CommandTemplate(0x200c, "BB")
+LE_CREATE_CONNECTION          = CommandTemplate(0x200d, "HHBBIHBHHHHHH")
+LE_ADD_DEVICE_TO_ACCEPT_LIST  = CommandTemplate(0x2011, "BIH")
+LE_READ_REMOTE_FEATURES       = CommandTemplate(0x2016, "H")
+
+ATT_EXCHANGE_MTU_REQ          = ACLTemplate(0x02, "H")
+ATT_FIND_INFORMATION_REQ      = ACLTemplate(0x04, "HH")
+ATT_READ_BY_TYPE_REQ          = ACLTemplate(0x08, "HHH")
+ATT_READ_REQ                  = ACLTemplate(0x0a, "H")
+
+
+################################################################
+#
+# HCI command handle
+#
+# One command given to the controller. done is set by its Command Complete or Command Status event,
+# with the status and, from Command Complete, the return parameters that follow the status byte
+#
+################################################################
+
+class HCICommand:
+
+    def __init__(self, opcode, packet):
+        self.opcode = opcode
+        self.packet = packet                  # the whole HCI packet, until it is sent
+        self.done = False
+        self.status = None
+        self.return_parameters = b''
+
+    def succeeded(self):
+        return self.done and self.status == HCI_SUCCESS
+
+
+################################################################
+#
+# ACL reassembly buffer
+#
+# Kept for each connection and reused for each PDU, only replaced by a bigger one when a PDU does
+# not fit. Fragments are copied in with memoryview writes
+#
+################################################################
+
+class ACLReassembly:
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.length = 0                       # L2CAP length of the PDU, from its first fragment
+        self.received = 0
+        self.channel = 0
+
+    def complete(self):
+        return self.received == self.length
+
+
 ################################################################
 #
 # Bluetooth class
@@ -129,35 +302,108 @@ def make_cmd(cmd, length):
 
 class BluetoothLEConnection:
 
-    def __init__(self, dev_id=0):
+    def __init__(self, dev_id=0, transport=None, high_speed=False, warm=False, firmware=None, irq=False):
         self.handle = 64
-        self.user_socket = CYW()
+        self.peer_address = 0
+        self.user_socket = CYW(transport, high_speed, warm, firmware, irq)
 
-        # ACL packet being constructed
-        self.acl_packet = None
-        self.acl_length = 0
-        self.acl_total_length = 0
+        # L2CAP PDUs being put together from ACL fragments, by connection handle
+        self.acl_rx = {}
+        self.acl_fragments = 0
+        self.acl_pdus = 0
+        self.acl_errors = 0
+
+        # Packets waiting to be sent together
+        self.tx_queue = []
 
         # Last command complete information
         self.command_complete = None
         self.command_status = None
 
+        # Commands go out as the controller hands back credits in Command Complete and Command Status
+        # events - sent and waiting for their event by opcode, and queued waiting for a credit.
+        # With pipelined set the do_ commands return their HCICommand as soon as it is queued
+        self.command_credits = 1
+        self.pending_commands = {}
+        self.command_queue = []
+        self.pipelined = False
+
+        # ACL flow control - each ACL packet sent uses one of the controller's buffers, given back by
+        # Number Of Completed Packets. Packets wait in acl_queue while none are free
+        self.acl_buffer_length = ACL_DEFAULT_LENGTH
+        self.acl_buffers = ACL_DEFAULT_BUFFERS
+        self.acl_credits = ACL_DEFAULT_BUFFERS
+        self.acl_in_flight = {}                # packets sent and not completed, by connection handle
+        self.acl_queue = []
+        self.acl_stalls = 0
+
+        # Dispatch tables - handlers by event code, LE meta subevent and Command Complete opcode -
+        # and the callbacks added by subscribe(), by event code
+        self.event_handlers = {
+            EVT_COMMAND_STATUS:              self.on_hci_event_command_status,
+            EVT_DISCONNECTION_COMPLETE:      self.on_hci_event_disconnect_complete,
+            EVT_LE_META:                     self.on_hci_meta_event,
+            EVT_COMMAND_COMPLETE:            self.on_hci_event_command_complete,
+            EVT_NUMBER_OF_COMPLETED_PACKETS: self.on_hci_event_number_of_completed_packets,
+        }
+        self.meta_handlers = {
+            0x01: self.on_le_connection_complete,
+            0x02: self.on_le_advertising_report,
+            0x03: self.on_le_connection_update_complete,
+            0x04: self.on_le_read_remote_features_complete,
+        }
+        self.command_handlers = {
+            0x0c03: self.on_reset_complete,
+            0x1005: self.on_read_buffer_size,
+            0x2002: self.on_le_read_buffer_size,
+        }
+        self.subscribers = {}
+
+        # The buffer size is picked up by the Command Complete handler whenever the reply arrives
+        self.issue_packet(0x2002, LE_READ_BUFFER_SIZE.pack())
+
     def __del__(self):
         self.user_socket.close()
         return
 
     ### helper functions calling BTUserSocket
 
-    def send(self, data):
-        print("\n<<", "Data sent: ", as_hex(data))
-        self.user_socket.send_raw(data)
+    # queue=True holds the packet back so it goes with the next send() or flush(), all in one
+    # write to the controller
+    def send(self, data, queue=False):
+        dump(TRANSPORT, TRACE, "\n<< Data sent: ", data)
+        self.tx_queue.append(data)
+        if not queue:
+            self.flush()
+
+    # Anything the controller had no room for stays queued, in order, for the next flush() - the
+    # command and ACL credits it took are still owed by the controller once it is sent. What stays
+    # is copied, because a template's buffer is packed again by the next command from it.
+    # Returns True if the queue is empty
+    def flush(self):
+        if self.tx_queue:
+            sent = self.user_socket.send_packets(self.tx_queue)
+            if sent == len(self.tx_queue):
+                self.tx_queue = []
+            else:
+                log(TRANSPORT, ERROR, "Send incomplete: {} packets still queued", len(self.tx_queue) - sent)
+                self.tx_queue = [bytes(p) for p in self.tx_queue[sent:]]
+        return not self.tx_queue
 
     def receive(self):
         data = self.user_socket.receive_raw()
-        print("\n>>", "Data received: ", as_hex(data))
+        dump(TRANSPORT, TRACE, "\n>> Data received: ", data)
         self.on_data(data)
         return data
 
+    # Handle every packet waiting in the receive buffer, from one read of it
+    def receive_all(self):
+        packets = self.user_socket.receive_packets()
+        for data in packets:
+            dump(TRANSPORT, TRACE, "\n>> Data received: ", data)
+            self.on_data(data)
+        return len(packets)
+
     def readable(self):
         return self.user_socket.readable()
 
@@ -166,23 +412,168 @@ class BluetoothLEConnection:
         timer = timeout
         while timer > 0:
             timer -= quanta
+            self.flush()                         # sends anything left over from a full H2BT buffer
             while self.readable():
-                a = self.receive()
+                self.receive_all()
             sleep(quanta)
 
-    def wait_complete(self, command, timeout = DATA_TIMEOUT):
-        quanta = 0.1
+    # Queue a command and send as many queued commands as there are credits for. Returns the
+    # HCICommand straight away
+    def issue_command(self, command, packet):
+        return self.issue_packet(command, make_cmd(command, len(packet)) + packet)
+
+    # As issue_command, with the whole HCI packet already made - by a CommandTemplate
+    def issue_packet(self, opcode, data):
+        hci_command = HCICommand(opcode, data)
+        self.command_queue.append(hci_command)
+        self.send_queued_commands()
+        if hci_command.packet is not None:
+            hci_command.packet = bytes(data)   # still waiting for a credit
+        return hci_command
+
+    def send_queued_commands(self):
+        while self.command_queue and self.command_credits > 0:
+            hci_command = self.command_queue.pop(0)
+            self.command_credits -= 1
+            self.pending_commands.setdefault(hci_command.opcode, []).append(hci_command)
+            self.send(hci_command.packet, queue=True)
+            hci_command.packet = None
+        self.flush()
+
+    # Called for each Command Complete and Command Status - the controller says how many more
+    # commands it will take, so the queue can move on without waiting for anything else
+    def command_done(self, opcode, credits, status, return_parameters=b''):
+        self.command_credits = credits
+        waiting = self.pending_commands.get(opcode)
+        if waiting:
+            hci_command = waiting.pop(0)
+            if not waiting:
+                del self.pending_commands[opcode]
+            hci_command.status = status
+            hci_command.return_parameters = return_parameters
+            hci_command.done = True
+        self.send_queued_commands()
+
+    # Give up on a command - if it was sent, take back its credit so later commands are not stuck
+    def abandon_command(self, hci_command):
+        log(HCI, ERROR, "Command timed out: {:#06x}", hci_command.opcode)
+        if hci_command in self.command_queue:
+            self.command_queue.remove(hci_command)
+            return
+        waiting = self.pending_commands.get(hci_command.opcode)
+        if waiting and hci_command in waiting:
+            waiting.remove(hci_command)
+            if not waiting:
+                del self.pending_commands[hci_command.opcode]
+            self.command_credits = max(self.command_credits, 1)
+            self.send_queued_commands()
+
+    def commands_outstanding(self):
+        return len(self.command_queue) + sum(len(w) for w in self.pending_commands.values())
+
+    def wait_command(self, hci_command, timeout = COMMAND_TIMEOUT):
+        quanta = 0.01
         timer = timeout
-        while timer > 0 and self.command_complete != command:
+        while True:
+            self.flush()
+            while self.readable():
+                self.receive_all()
+            if hci_command.done or timer <= 0:
+                break
             timer -= quanta
+            sleep(quanta)
+        if not hci_command.done:
+            self.abandon_command(hci_command)
+        return hci_command
+
+    # Wait for every command issued so far
+    def wait_commands(self, timeout = COMMAND_TIMEOUT):
+        quanta = 0.01
+        timer = timeout
+        while True:
+            self.flush()
             while self.readable():
-                a = self.receive()
+                self.receive_all()
+            if self.commands_outstanding() == 0 or timer <= 0:
+                break
+            timer -= quanta
             sleep(quanta)
+        late = self.command_queue + [c for w in self.pending_commands.values() for c in w]
+        for hci_command in late:
+            self.abandon_command(hci_command)
+        return not late
+
+    # Send an ACL packet if the controller has a free buffer, otherwise queue it until
+    # Number Of Completed Packets frees one
+    def send_acl(self, data):
+        if self.acl_credits == 0:
+            self.acl_stalls += 1
+        self.acl_queue.append(data)
+        self.send_queued_acl()
+        if self.acl_queue and self.acl_queue[-1] is data:
+            self.acl_queue[-1] = bytes(data)   # still waiting for a credit
+
+    # Send an L2CAP PDU split into fragments that fit the controller's ACL buffers - the first with
+    # the L2CAP header, the rest as continuations. They go out together as far as the credits allow
+    def send_l2cap(self, handle, channel, data):
+        pdu = from_u16(len(data)) + from_u16(channel) + data
+        size = self.acl_buffer_length
+        pb = ACL_PB_FIRST
+        for start in range(0, len(pdu), size):
+            fragment = pdu[start: start + size]
+            self.acl_queue.append(make_acl_fragment(handle, pb, len(fragment)) + fragment)
+            pb = ACL_PB_CONTINUATION
+        if len(self.acl_queue) > self.acl_credits:
+            self.acl_stalls += 1
+        self.send_queued_acl()
+
+    def send_att(self, data):
+        self.send_l2cap(self.handle, ATT_CID, data)
+
+    def send_att_template(self, template, *fields):
+        packet = template.pack(self.handle, *fields)
+        if template.size + 4 <= self.acl_buffer_length:
+            self.send_acl(packet)
+        else:
+            self.send_att(bytes(packet[9:]))
+
+    def send_queued_acl(self):
+        while self.acl_queue and self.acl_credits > 0:
+            data = self.acl_queue.pop(0)
+            handle = to_u16(data, 1) & 0x0fff
+            self.acl_credits -= 1
+            self.acl_in_flight[handle] = self.acl_in_flight.get(handle, 0) + 1
+            self.send(data, queue=True)
+        self.flush()
+
+    def set_acl_buffers(self, length, count):
+        log(ACL, INFO, "ACL buffers: {} of {} bytes", count, length)
+        self.acl_buffer_length = length
+        self.acl_buffers = count
+        self.acl_credits = max(count - sum(self.acl_in_flight.values()), 0)
+        self.send_queued_acl()
+
+    def acl_completed(self, handle, count):
+        in_flight = self.acl_in_flight.get(handle, 0)
+        count = min(count, in_flight)
+        if count == in_flight:
+            self.acl_in_flight.pop(handle, None)
+        else:
+            self.acl_in_flight[handle] = in_flight - count
+        self.acl_credits = min(self.acl_credits + count, self.acl_buffers)
+        self.send_queued_acl()
+
+    def send_command(self, command, packet, timeout = COMMAND_TIMEOUT):
+        return self.send_command_packet(command, make_cmd(command, len(packet)) + packet, timeout)
 
-    def send_command(self, command, packet):
-        cmd = make_cmd(command, len(packet)) + packet
-        self.send(cmd)
-        self.wait_complete(command, COMMAND_TIMEOUT)
+    def send_template(self, template, *fields):
+        return self.send_command_packet(template.opcode, template.pack(*fields))
+
+    def send_command_packet(self, opcode, data, timeout = COMMAND_TIMEOUT):
+        hci_command = self.issue_packet(opcode, data)
+        if self.pipelined:
+            return hci_command
+        return self.wait_command(hci_command, timeout)
 
     ################################################################
     #
@@ -217,13 +608,13 @@ class BluetoothLEConnection:
         #     supervision_timeout                            2 octets
         #     central_clock_accuracy                         1 octet
       
-        status = to_u8(data, 4)
-        handle = to_u16(data, 5)
-        address = to_addr(data, 9)
-        
+        status, handle = unpack_from("<BH", data, 4)
+
         self.handle = handle         # save this for other commands to use
-        print("LE Connection Complete")
-        print("Status: {:02x} Address: {}".format(status, address))
+        self.peer_address = to_addr_int(data, 9)
+        log(HCI, INFO, "LE Connection Complete")
+        if enabled(HCI, INFO):
+            log(HCI, INFO, "Status: {:02x} Address: {}", status, addr_str(self.peer_address))
 
     def on_le_advertising_report(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.65.2 LE Advertising Report (p2238)
@@ -241,32 +632,23 @@ class BluetoothLEConnection:
         #         data[i]                                    data_length octets
         #         rssi[i]                                    1 octet
         
-        # These lines double the report to test for num_reports = 2
-        # num_reports = to_u8       (data, 4)
-        # reports =     to_data_rest(data, 5)
-        # data = data[0:4] + from_u8(2) + reports + reports
-
-        num_reports = to_u8       (data, 4)
-        reports =     to_data_rest(data, 5)                  # the actual 'reports'
-        
-        report_offset = 0                                    # start of this entry in 'reports'
-        for rep in range(0, num_reports):
-            address =     to_addr (reports, report_offset+2)
-            data_len =    to_u8   (reports, report_offset+8)
-            report_data = to_data (reports, report_offset+9, data_len)
-            rssi =        to_u8   (reports, report_offset+9+data_len)
-            
-            print("Address: {}      RSSI: {}".format(address, rssi))
+        # Nothing is done with the reports except print them - subscribe to EVT_LE_ADVERTISING_REPORT
+        # and use le_advertising_reports() to do more
+        if not enabled(SCAN, DEBUG):
+            return
+
+        for event_type, address_type, address, report_data, rssi in le_advertising_reports(data):
+            log(SCAN, DEBUG, "Address: {}      RSSI: {}", addr_str(address), rssi)
+            data_len = len(report_data)
             i = 0
             while i < data_len:
-                entry_len = to_u8(report_data, i) 
+                entry_len = report_data[i]
                 if entry_len > 0:
-                    typ = to_u8  (report_data, i+1)
-                    dat = to_data(report_data, i+2, entry_len-1)
-                    print("Length: {:3} Type: {:02x}  Data: {}      {}".format(entry_len, typ, as_hex(dat), as_printable(dat)))
+                    typ = report_data[i+1]
+                    dat = report_data[i+2: i+1+entry_len]
+                    log(SCAN, DEBUG, "Length: {:3} Type: {:02x}  Data: {}      {}", entry_len, typ, as_hex(dat), as_printable(dat))
                     i += entry_len
                 i += 1
-            report_offset += data_len+10                     # move on to next entry
                   
     def on_le_connection_update_complete(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.65.3 LE Connection Update Complete (p2240)
@@ -288,8 +670,8 @@ class BluetoothLEConnection:
         latency = to_u16(data, 9)
         timeout =  to_u16(data, 11)
         
-        print("LE Connection Update Complete")
-        print("Handle: {:04x} Status: {02x}".format(handle, status))
+        log(HCI, INFO, "LE Connection Update Complete")
+        log(HCI, INFO, "Handle: {:04x} Status: {:02x}", handle, status)
         
         #self.handle = handle         # save this for other commands to use
 
@@ -307,12 +689,12 @@ class BluetoothLEConnection:
         #     connection_handle                              2 octets
         #     le features                                    8 octets      # need to update templates for this!!
 
-        print("Read Remote Features Complete")
+        log(HCI, INFO, "Read Remote Features Complete")
         
         handle = to_u16(data, 5)
-        features = to_data_rest(data, 7)
         
-        print("Handle: {} Features {}".format(handle, as_hex(features)))
+        if enabled(HCI, INFO):
+            log(HCI, INFO, "Handle: {} Features {}", handle, as_hex(to_data_rest(data, 7)))
 
     def on_hci_meta_event(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.65 LE Meta event (p2235)
@@ -324,17 +706,18 @@ class BluetoothLEConnection:
         #     data                                           n octets
 
         subevent_code = to_u8(data, 3)
-        print("Event: LE Meta event: ", hex(subevent_code))
-        if   subevent_code == 0x01:                 # LE Connection Complete
-            self.on_le_connection_complete(data)
-        elif subevent_code == 0x03:                 # LE Connection Update Complete
-            self.on_le_update_complete(data)
-        elif subevent_code == 0x02:                 # LE Advertising Report
-            self.on_le_advertising_report(data)
-        elif subevent_code == 0x04:                 # LE Read Remove Features Complete
-            self.on_le_read_remote_features_complete(data)
-        else:
-            print("LE Meta Event: Unhandled:", hex(subevent_code))
+        handler = self.meta_handlers.get(subevent_code)
+        callbacks = self.subscribers.get(EVT_LE_META << 8 | subevent_code)
+        if handler is None and callbacks is None:
+            log(HCI, DEBUG, "LE Meta Event: Unhandled: {:#x}", subevent_code)
+            return
+
+        log(HCI, DEBUG, "Event: LE Meta event:  {:#x}", subevent_code)
+        if handler is not None:
+            handler(data)
+        if callbacks is not None:
+            for callback in callbacks:
+                callback(data)
 
     def on_hci_event_disconnect_complete(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.5 HCI_Disconnection_Complete (p2163)
@@ -346,11 +729,19 @@ class BluetoothLEConnection:
         #     connection_handle                              2 octets
         #     reason                                         1 octet
 
-        print("Event: HCI Disconnection Complete")
+        log(HCI, INFO, "Event: HCI Disconnection Complete")
         status = to_u8  (data, 3)
         handle = to_u16 (data, 4)
         reason = to_u8  (data, 6)
 
+        # The controller drops anything still queued for the connection, and frees its buffers.
+        # Packets for it still waiting here are dropped first, so they don't go to a dead link
+        self.acl_queue = [p for p in self.acl_queue if to_u16(p, 1) & 0x0fff != handle]
+        in_flight = self.acl_in_flight.pop(handle, 0)
+        self.acl_credits = min(self.acl_credits + in_flight, self.acl_buffers)
+        self.send_queued_acl()
+        self.acl_rx.pop(handle, None)
+
     def on_hci_event_command_complete(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.14 HCI Command Complete (p2177)
         #     [packet_type                                   1 octet]
@@ -363,27 +754,58 @@ class BluetoothLEConnection:
         # First return_parameters field is usually
         #     status                                         1 octet
 
-        print("Event: HCI Command Complete")
+        log(HCI, DEBUG, "Event: HCI Command Complete")
         cmd =    to_u16 (data, 4)
         status = to_u8  (data, 6)
         status_text = "Success" if status == HCI_SUCCESS else "Failure"
         self.command_complete = cmd
         self.command_status =   status
+        self.command_done(cmd, to_u8(data, 3), status, bytes(to_data_rest(data, 7)))
+
+        name = COMMAND_NAMES.get(cmd)
+        if name is None:
+            log(HCI, INFO, "LE Unknown Command: {:#x} {}", cmd, status_text)
+        else:
+            log(HCI, INFO, "{}: {}", name, status_text)
+
+        handler = self.command_handlers.get(cmd)
+        if handler is not None:
+            handler(data)
+
+    def on_reset_complete(self, data):
+        # The controller has dropped every ACL packet it held
+        self.acl_in_flight = {}
+        self.acl_credits = self.acl_buffers
+        self.send_queued_acl()
 
-        if   cmd == 0x200b:                                       # LE Set Scan Paramaters
-            print('LE Scan Parameters Set:',status_text);
-        elif cmd == 0x200c:                                       # LE Set Scan Enable
-            print('LE Scan Enable Set:', status_text)
-        elif cmd == 0x2006:                                       # LE Set Advertising Parameters
-            print('LE Advertising Parameters Set:', status_text)
-        elif cmd == 0x2008:                                       # LE Set Advertising Data
-            print('LE Advertising Data Set:', status_text)
-        elif cmd == 0x2009:                                       # LE Set Scan Repsonse Data
-            print('LE Scan Response Data Set:', status_text)
-        elif cmd == 0x200a:                                       # LE Set Advertise Enable
-            print('LE Advertise Enable Set:', status_text)
+    def on_le_read_buffer_size(self, data):
+        # Specification v5.4  Vol 4 Part E 7.8.2 LE Read Buffer Size (p2343)
+        #     [command complete header                       6 octets]
+        #     status                                         1 octet
+        #     le_acl_data_packet_length                      2 octets
+        #     total_num_le_acl_data_packets                  1 octet
+        #
+        # A length of 0 means LE shares the BR/EDR buffers, from Read Buffer Size
+
+        if to_u8(data, 6) != HCI_SUCCESS:
+            return
+        length = to_u16(data, 7)
+        if length == 0:
+            self.issue_packet(0x1005, READ_BUFFER_SIZE.pack())
         else:
-            print('LE Unknown Command:', hex(cmd), status_text)
+            self.set_acl_buffers(length, to_u8(data, 9))
+
+    def on_read_buffer_size(self, data):
+        # Specification v5.4  Vol 4 Part E 7.4.5 Read Buffer Size (p2132)
+        #     [command complete header                       6 octets]
+        #     status                                         1 octet
+        #     acl_data_packet_length                         2 octets
+        #     synchronous_data_packet_length                 1 octet
+        #     total_num_acl_data_packets                     2 octets
+        #     total_num_synchronous_data_packets             2 octets
+
+        if to_u8(data, 6) == HCI_SUCCESS:
+            self.set_acl_buffers(to_u16(data, 7), to_u16(data, 10))
 
     def on_hci_event_command_status(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.15 HCI_Command_Status (p2179)
@@ -395,11 +817,13 @@ class BluetoothLEConnection:
         #     num_hci_command_packets                        1 octet
         #     command_opcode                                 2 octets
 
-        print("Event: HCI Command Status")
+        log(HCI, DEBUG, "Event: HCI Command Status")
         status = to_u8  (data, 3)
         opcode = to_u16 (data, 5)
 
-        print("Opcode: {:02x} status: {:02x}".format(opcode, status))
+        log(HCI, DEBUG, "Opcode: {:02x} status: {:02x}", opcode, status)
+        self.command_status = status
+        self.command_done(opcode, to_u8(data, 4), status)
 
     def on_hci_event_number_of_completed_packets(self, data):
         # Specification v5.4  Vol 4 Part E 7.7.19 HCI Number Of Completed Packets (p2184)
@@ -407,10 +831,16 @@ class BluetoothLEConnection:
         #     [event_code                                    1 octet]
         #     [parameter_length                              1 octet]
         #     num_handles                                    1 octet
-        #     connection handle[i]                           2n octets
-        #     num completed packets[i]                       2n octets
+        #     connection handle[i]                           2 octets    } num_handles pairs
+        #     num completed packets[i]                       2 octets    }
 
-        print("Event: HCI Number Of Completed Packets")
+        log(HCI, DEBUG, "Event: HCI Number Of Completed Packets")
+        num_handles = to_u8(data, 3)
+        for i in range(0, num_handles):
+            handle = to_u16(data, 4 + i * 4) & 0x0fff
+            count =  to_u16(data, 6 + i * 4)
+            log(ACL, DEBUG, "Handle: {:04x} Completed: {}", handle, count)
+            self.acl_completed(handle, count)
 
     def on_hci_event(self, data):
         # Specification v5.4  Vol 4 Part E 5.4.4 HCI Event Packet (p1804)
@@ -419,25 +849,37 @@ class BluetoothLEConnection:
         #     parameter_length                               1 octet
         #     parameters                                     n octets
 
-        event = to_u8(data, 1)         
-        print("HCI Event Packet:", hex(event))
-
-        if   event == 0x0f:                                   # Command Status
-            self.on_hci_event_command_status(data)
-        elif event == 0x05:                                   # Disconnection Complete
-            self.on_hci_event_disconnect_complete(data)
-        elif event == 0x3e:                                   # LE Meta Event
-            self.on_hci_meta_event(data)
-        elif event == 0x0e:                                   # Command complete
-            self.on_hci_event_command_complete(data)
-        elif event == 0x13:                                   # Number of Completed Packets
-            self.on_hci_event_number_of_completed_packets(data)
-        else:
-            print("HCI Event: Unhandled", hex(event))
+        # Events nobody handles or subscribes to are dropped here, before anything is decoded
+
+        event = to_u8(data, 1)
+        handler = self.event_handlers.get(event)
+        callbacks = self.subscribers.get(event)
+        if handler is None and callbacks is None:
+            log(HCI, DEBUG, "HCI Event: Unhandled {:#x}", event)
+            return
+
+        log(HCI, DEBUG, "HCI Event Packet: {:#x}", event)
+        if handler is not None:
+            handler(data)
+        if callbacks is not None:
+            for callback in callbacks:
+                callback(data)
+
+    # callback(data) is called with the whole event packet, after the class's own handler. event
+    # is an event code, or EVT_LE_META << 8 | subevent code for one kind of LE meta event
+    def subscribe(self, event, callback):
+        self.subscribers.setdefault(event, []).append(callback)
+
+    def unsubscribe(self, event, callback):
+        callbacks = self.subscribers.get(event)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.subscribers[event]
 
 
     def on_acl_event(self, data):
-        print("ACL data:      ", as_hex(data))
+        dump(ATT, DEBUG, "ACL data:      ", data)
 
 
     def on_acl_packet(self, data):
@@ -449,41 +891,71 @@ class BluetoothLEConnection:
         #     channel                                       2 octets
         #     data                                          n octets
 
-        print("ACL Packet")
+        # A finished PDU is passed to on_acl_event as a memoryview - of the received packet if it
+        # came in one fragment, otherwise of the connection's reassembly buffer. It is only valid
+        # until the next packet is handled
 
-        handle = to_bits_u16(data, 1, 0, 12)
-        pb =     to_bits_u16(data, 1, 12, 2)
-        bc =     to_bits_u16(data, 1, 14, 2)
-        length = to_u16(data, 3)  #di["packet length"]
- 
-        full_packet = False
-        print('ACL header: handle: {}  bc: {}  pb: {}'.format(handle, bc, pb))
+        log(ACL, DEBUG, "ACL Packet")
 
+        flags, length = unpack_from("<HH", data, 1)
+        handle = flags & 0x0fff
+        pb =     (flags >> 12) & 0x03
+        bc =     flags >> 14
+        self.acl_fragments += 1
+        mv = memoryview(data)
+
+        log(ACL, DEBUG, "ACL header: handle: {}  bc: {}  pb: {}", handle, bc, pb)
+
+        rx = self.acl_rx.get(handle)
         if pb & 0x01 == 0:
-            size =     to_u16(data, 5)
-            channel =  to_u16(data, 7)
-            acl_data = to_data_rest(data, 9)
+            size, channel = unpack_from("<HH", data, 5)
+            acl_data = mv[9: 5 + length]
             full_packet = length - size == 4
 
-            print("Channel: {} Length: {} Data size: {} Full packet? {}".format(channel, length, size, full_packet))
-            print("ACL packet:    ", as_hex(acl_data))
-
-            self.acl_total_length = size
-            self.acl_packet =       acl_data
-
-        if pb & 0x01 == 1:
-            print("ACL Packet Continuation")
-            acl_data = to_data_rest(data, 5)
-            self.acl_packet += acl_data
-            print("ACL data:  ", as_hex(acl_data))
-            if len(self.acl_packet) == self.acl_total_length:    # This was the last continuation packet
-                full_packet = True
-                print("ACL Packet Final")
-                print("Full ACL data: ", as_hex(self.acl_packet))
-                
-        if full_packet:
-            self.on_acl_event(self.acl_packet)                 
-            
+            log(ACL, DEBUG, "Channel: {} Length: {} Data size: {} Full packet? {}", channel, length, size, full_packet)
+            dump(ACL, TRACE, "ACL packet:    ", acl_data)
+
+            if rx is not None and not rx.complete():
+                self.acl_errors += 1                           # the last PDU never finished
+                log(ACL, ERROR, "ACL Packet incomplete: handle {} {} of {}", handle, rx.received, rx.length)
+                rx.length = rx.received = 0
+            if full_packet:
+                self.acl_pdus += 1
+                self.on_acl_event(acl_data)
+                return
+            if rx is None or len(rx.buf) < size:
+                rx = ACLReassembly(size)
+                self.acl_rx[handle] = rx
+            rx.length = size
+            rx.received = 0
+            rx.channel = channel
+        else:
+            log(ACL, DEBUG, "ACL Packet Continuation")
+            acl_data = mv[5: 5 + length]
+            dump(ACL, TRACE, "ACL data:  ", acl_data)
+            if rx is None or rx.complete():
+                self.acl_errors += 1                           # nothing to continue
+                log(ACL, ERROR, "ACL Packet Continuation unexpected: handle {}", handle)
+                return
+
+        end = rx.received + len(acl_data)
+        if end > rx.length:
+            self.acl_errors += 1                               # more data than the L2CAP length
+            log(ACL, ERROR, "ACL Packet too long: handle {} {} of {}", handle, end, rx.length)
+            rx.length = rx.received = 0
+            return
+        rx.mv[rx.received: end] = acl_data
+        rx.received = end
+
+        if rx.complete():                                      # This was the last continuation packet
+            self.acl_pdus += 1
+            log(ACL, DEBUG, "ACL Packet Final")
+            dump(ACL, TRACE, "Full ACL data: ", rx.mv[0: rx.length])
+            self.on_acl_event(rx.mv[0: rx.length])
+
+    def acl_stats(self):
+        return {"acl_fragments": self.acl_fragments, "acl_pdus": self.acl_pdus,
+                "acl_errors": self.acl_errors, "acl_stalls": self.acl_stalls}
 
     # HCI packet received handler
 
@@ -494,17 +966,14 @@ class BluetoothLEConnection:
         #     packet_type                                    1 octet
 
         packet_type = to_u8(data, 0)
-        print("Packet type:", packet_type)
-
-        self.command_complete = None               # set to None and changed by Command Complete event
-        self.command_status = None
+        log(TRANSPORT, DEBUG, "Packet type: {}", packet_type)
 
         if   packet_type == 0x04:                  # event packet
             self.on_hci_event(data)
         elif packet_type == 0x02:                  # ACL data packet
             self.on_acl_packet(data)
         else:
-            print("Unhandled packet type", packet_type)
+            log(TRANSPORT, ERROR, "Unhandled packet type {}", packet_type)
 
     ################################################################
     #
@@ -537,17 +1006,12 @@ class BluetoothLEConnection:
         # Response:
         #     HCI Command Complete                          0x0e  0x2006
 
-        print(cmd_text, "LE Set Advertising Parameters")
+        log(HCI, INFO, "{} LE Set Advertising Parameters", cmd_text)
         
-        packet =  from_u16  (min_interval)
-        packet += from_u16  (max_interval)
-        packet += from_u8   (adv_type)
-        packet += from_u8   (own_addr_type)
-        packet += from_u8   (peer_addr_type)
-        packet += from_addr (peer_addr)
-        packet += from_u8   (adv_channel_map)
-        packet += from_u8   (adv_filter_policy)
-        self.send_command(0x2006, packet)
+        peer = addr_to_int(peer_addr)
+        return self.send_template(LE_SET_ADVERTISING_PARAMETERS, min_interval, max_interval, adv_type,
+                                  own_addr_type, peer_addr_type, peer & 0xffffffff, peer >> 32,
+                                  adv_channel_map, adv_filter_policy)
 
     def do_set_advertising_data(self, data):
         # Specification v5.4  Vol 4 Part E 7.8.7 LE Set Advertising Data (p2355)
@@ -562,13 +1026,9 @@ class BluetoothLEConnection:
         # Response:
         #     HCI Command Complete                          0x0e  0x2008
 
-        print(cmd_text, "LE Set Advertising Data")
+        log(HCI, INFO, "{} LE Set Advertising Data", cmd_text)
 
-        pad = bytes(b'\x00' * (31-len(data)))
-        packet = from_u8 (len(data))
-        packet +=         data
-        packet +=         pad
-        self.send_command(0x2008, packet)
+        return self.send_template(LE_SET_ADVERTISING_DATA, len(data), data)      # padded to 31 octets
 
     def do_set_scan_response_data(self, data):
         # Specification v5.4  Vol 4 Part E 7.8.8 LE Set Scan Response Data (p2357)
@@ -583,13 +1043,8 @@ class BluetoothLEConnection:
         # Response:
         #     HCI Command Complete                          0x0e  0x2009
 
-        print(cmd_text, "LE Set Scan Response Data")
-        pad = bytes(b'\x00' * (31 - len(data)))
-
-        packet =  from_u8 (len(data))
-        packet +=         data
-        packet +=         pad
-        self.send_command(0x2009, packet)
+        log(HCI, INFO, "{} LE Set Scan Response Data", cmd_text)
+        return self.send_template(LE_SET_SCAN_RESPONSE_DATA, len(data), data)    # padded to 31 octets
 
     def do_set_advertise_enable(self, enabled):
         # Specification v5.4  Vol 4 Part E 7.8.9 LE Set Advertising Enable (p2359)
@@ -604,10 +1059,28 @@ class BluetoothLEConnection:
         #     HCI Command Complete                          0x0e  0x200a
         #     HCI LE Connection Complete                    0x3e  0x01      (in some cases)
 
-        print(cmd_text, "LE Set Advertising Enable")
+        log(HCI, INFO, "{} LE Set Advertising Enable", cmd_text)
         
-        packet = from_u8(0x01 if enabled else 0x00)
-        self.send_command(0x200a, packet)
+        return self.send_template(LE_SET_ADVERTISE_ENABLE, 0x01 if enabled else 0x00)
+
+    def do_start_advertising(self, data, scan_response_data=b'', adv_type=0x00,
+                             min_interval=0x00a0, max_interval=0x00a0):
+        # The advertising set up as one pipelined sequence - each command goes as soon as the
+        # controller has a credit for it, rather than after the previous one has been waited for
+        #
+        # Returns True if every command completed
+
+        pipelined = self.pipelined
+        self.pipelined = True
+        commands = [self.do_set_advertise_enable(False),
+                    self.do_set_advertising_parameters(adv_type, min_interval=min_interval,
+                                                       max_interval=max_interval),
+                    self.do_set_advertising_data(data),
+                    self.do_set_scan_response_data(scan_response_data),
+                    self.do_set_advertise_enable(True)]
+        self.pipelined = pipelined
+        self.wait_commands(COMMAND_TIMEOUT)
+        return all(c.succeeded() for c in commands)
 
     def do_set_scan_parameters(self, scan_type=SCAN_TYPE_ACTIVE, scan_internal=0x0060, scan_window=0x0060,
                                own_addr_type=LE_PUBLIC_ADDRESS, scan_filter_policy=FILTER_POLICY_NO_WHITELIST):
@@ -626,14 +1099,10 @@ class BluetoothLEConnection:
         # Response:
         #     HCI Command Complete                          0x0e  0x200b
 
-        print(cmd_text, "LE Set Scan Parameters")
+        log(HCI, INFO, "{} LE Set Scan Parameters", cmd_text)
         
-        packet =  from_u8  (scan_type)
-        packet += from_u16 (scan_internal)
-        packet += from_u16 (scan_window)
-        packet += from_u8  (own_addr_type)
-        packet += from_u8  (scan_filter_policy)
-        self.send_command(0x200b, packet)
+        return self.send_template(LE_SET_SCAN_PARAMETERS, scan_type, scan_internal, scan_window,
+                                  own_addr_type, scan_filter_policy)
 
     def do_set_scan(self, enabled=False, duplicates=False):
         # Specification v5.4  Vol 4 Part E 7.8.11 LE Set Scan Enable (p2364)
@@ -652,11 +1121,9 @@ class BluetoothLEConnection:
         #enable = 0x01 if enabled else 0x00
         #dups   = 0x01 if duplicates else 0x00
 
-        print(cmd_text, "LE Set Scan Enable" if enabled else "LE Set Scan Disable")
+        log(HCI, INFO, "{} {}", cmd_text, "LE Set Scan Enable" if enabled else "LE Set Scan Disable")
         
-        packet =  from_u8(0x01 if enabled else 0x00)
-        packet += from_u8(0x01 if duplicates else 0x00)        
-        self.send_command(0x200c, packet)
+        return self.send_template(LE_SET_SCAN_ENABLE, 0x01 if enabled else 0x00, 0x01 if duplicates else 0x00)
 
     def do_create_connection(self, addr, addr_type, interval=0x0060, window=0x0060, initiator_filter=0x00,
                              own_addr_type= 0x00, min_interval=0x0018, max_interval=0x0028, latency=0x0000,
@@ -684,21 +1151,12 @@ class BluetoothLEConnection:
         #     HCI Command Complete                          0x0e  0x200d
         #     HCI LE Connection Complete                    0x3e  0x01
 
-        print(cmd_text, "LE Create Connection")
+        log(HCI, INFO, "{} LE Create Connection", cmd_text)
         
-        packet =  from_u16 (interval)
-        packet += from_u16 (window)
-        packet += from_u8  (initiator_filter)
-        packet += from_u8  (addr_type)
-        packet += from_addr(addr)
-        packet += from_u8  (own_addr_type)
-        packet += from_u16 (min_interval)
-        packet += from_u16 (max_interval)
-        packet += from_u16 (latency)
-        packet += from_u16 (supervision_timeout)
-        packet += from_u16 (min_ce_length)
-        packet += from_u16 (max_ce_length)
-        self.send_command(0x200d, packet)
+        peer = addr_to_int(addr)
+        return self.send_template(LE_CREATE_CONNECTION, interval, window, initiator_filter, addr_type,
+                                  peer & 0xffffffff, peer >> 32, own_addr_type, min_interval, max_interval,
+                                  latency, supervision_timeout, min_ce_length, max_ce_length)
         
 
     def do_add_device_to_accept_list(self, addr, addr_type):
@@ -715,11 +1173,10 @@ class BluetoothLEConnection:
         #     HCI Command Complete                          0x0e  0x2011
 
 
-        print(cmd_text, "LE Add Device To Filter Accept List")
+        log(HCI, INFO, "{} LE Add Device To Filter Accept List", cmd_text)
         
-        packet =  from_u8(addr_type)
-        packet += from_addr(addr)
-        self.send_command(0x2011, packet)
+        peer = addr_to_int(addr)
+        return self.send_template(LE_ADD_DEVICE_TO_ACCEPT_LIST, addr_type, peer & 0xffffffff, peer >> 32)
 
     def do_read_remote_used_features(self):
         # Specification v5.4  Vol 4 Part E 7.8.21 LE Read Remote Features (p2385)
@@ -734,10 +1191,9 @@ class BluetoothLEConnection:
         #     HCI Command Complete                          0x0e  0x2016
         #     HCI LE Read Remote Features Complete          0x3e  0x04  
 
-        print(cmd_text, "LE Read Remote Features")
+        log(HCI, INFO, "{} LE Read Remote Features", cmd_text)
         
-        packet = from_u16(self.handle)
-        self.send_command(0x2016, packet)
+        return self.send_template(LE_READ_REMOTE_FEATURES, self.handle)
 
     #
     # ACL commands
@@ -754,13 +1210,9 @@ class BluetoothLEConnection:
         #     opcode                                        1 octet
         #     client receive mtu size                       2 octets
 
-        print(att_text, "ATT EXCHANGE MTU REQ")
+        log(ATT, INFO, "{} ATT EXCHANGE MTU REQ", att_text)
 
-        packet =  from_u8  (0x02)           # ATT opcode ATT_EXCHANGE_MTU_REQ
-        packet += from_u16 (mtu_size)       # MTU size requested
-        
-        cmd = make_acl(self.handle, len(packet)) + packet
-        self.send(cmd)
+        self.send_att_template(ATT_EXCHANGE_MTU_REQ, mtu_size)
 
 
     def do_att_find_information_req(self, start_handle, end_handle):
@@ -776,14 +1228,9 @@ class BluetoothLEConnection:
         #     starting handle                               2 octets
         #     ending handle                                 2 octets
 
-        print(att_text, "ATT FIND INFORMATION REQ")
+        log(ATT, INFO, "{} ATT FIND INFORMATION REQ", att_text)
         
-        packet =  from_u8  (0x04)          # ATT opcode ATT_FIND_INFORMATION_REQ
-        packet += from_u16 (start_handle)
-        packet += from_u16 (end_handle)
-
-        cmd = make_acl(self.handle, len(packet)) + packet
-        self.send(cmd)
+        self.send_att_template(ATT_FIND_INFORMATION_REQ, start_handle, end_handle)
 
 
     def do_att_read_by_type_req(self, start_handle, end_handle, attribute_type):
@@ -800,15 +1247,9 @@ class BluetoothLEConnection:
         #     ending handle                                 2 octets
         #     attribute type (UUID)                         2 or 16 octets
 
-        print(att_text, "ATT READ BY TYPE REQ")
+        log(ATT, INFO, "{} ATT READ BY TYPE REQ", att_text)
         
-        packet =  from_u8  (0x08)               # ATT opcode ATT_READ_BY_TYPE_REQ
-        packet += from_u16 (start_handle)
-        packet += from_u16 (end_handle)
-        packet += from_u16 (attribute_type)        
-               
-        cmd = make_acl(self.handle, len(packet)) + packet
-        self.send(cmd)
+        self.send_att_template(ATT_READ_BY_TYPE_REQ, start_handle, end_handle, attribute_type)
 
 
     def do_att_read_req(self, handle):
@@ -823,12 +1264,54 @@ class BluetoothLEConnection:
         #     opcode                                        1 octet
         #     handle                                        2 octets
 
-        print(att_text, "ATT READ REQ")
+        log(ATT, INFO, "{} ATT READ REQ", att_text)
         
-        packet =  from_u8  (0x0a)               # ATT opcode ATT_READ_REQ
+        self.send_att_template(ATT_READ_REQ, handle)
+
+
+    def do_att_write_req(self, handle, value):
+        # Specification v5.4  Vol 3 Part F 3.4.5.1 ATT_WRITE_REQ (p1437)
+        # ATT Opcode 0x12
+        #
+        #     [packet_type                                  1 octet]
+        #     [handle (BC[2] PB[2] handle[12])              2 octets]
+        #     [packet length                                2 octets]
+        #     [data_length                                  2 octets]
+        #     [channel                                      2 octets]
+        #     opcode                                        1 octet
+        #     handle                                        2 octets
+        #     value                                         0 to (ATT_MTU-3) octets
+        #
+        # Larger than the controller's ACL buffers it goes as several fragments
+
+        log(ATT, INFO, "{} ATT WRITE REQ", att_text)
+
+        packet =  from_u8  (0x12)               # ATT opcode ATT_WRITE_REQ
+        packet += from_u16 (handle)
+        packet += from_data(value)
+
+        self.send_att(packet)
+
+
+    def do_att_handle_value_ntf(self, handle, value):
+        # Specification v5.4  Vol 3 Part F 3.4.7.1 ATT_HANDLE_VALUE_NTF (p1444)
+        # ATT Opcode 0x1b
+        #
+        #     [packet_type                                  1 octet]
+        #     [handle (BC[2] PB[2] handle[12])              2 octets]
+        #     [packet length                                2 octets]
+        #     [data_length                                  2 octets]
+        #     [channel                                      2 octets]
+        #     opcode                                        1 octet
+        #     handle                                        2 octets
+        #     value                                         0 to (ATT_MTU-3) octets
+
+        log(ATT, INFO, "{} ATT HANDLE VALUE NTF", att_text)
+
+        packet =  from_u8  (0x1b)               # ATT opcode ATT_HANDLE_VALUE_NTF
         packet += from_u16 (handle)
-               
-        cmd = make_acl(self.handle, len(packet)) + packet
-        self.send(cmd)
+        packet += from_data(value)
+
+        self.send_att(packet)
 
   
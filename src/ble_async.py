@@ -0,0 +1,138 @@
+# asyncio version of the BLE HCI class
+#
+# A reader task drains the CYW43439 as soon as data is there - woken by the host interrupt, with a
+# slow poll as a backstop - so nothing waits in sleep() loops and other tasks run while the HCI
+# transport is idle.
+#
+#     async def main():
+#         ble = AsyncBluetoothLEConnection(1)
+#         ble.listen(on_packet)                    # async def on_packet(data), called for every packet
+#         ble.start()
+#         await ble.do_set_scan_parameters()       # the HCI commands are awaitable
+#         await ble.do_set_scan(True, False)
+#         ...
+#         await ble.stop()
+#     asyncio.run(main())
+#
+# Packets are handled by the same on_* handlers as BluetoothLEConnection. Commands return their
+# HCICommand when its Command Complete or Command Status arrives, or after the timeout. ATT requests
+# are sent straight away and their responses arrive through the listeners.
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from ble import *
+from time import ticks_add
+
+POLL_MS = 50
+
+# ThreadSafeFlag can be set from an interrupt handler - CPython has no interrupts, so an Event will do
+Flag = getattr(asyncio, "ThreadSafeFlag", asyncio.Event)
+
+
+async def wait_flag(flag, timeout_ms):
+    try:
+        await asyncio.wait_for(flag.wait(), timeout_ms / 1000)
+    except asyncio.TimeoutError:
+        pass
+    if hasattr(flag, "clear"):
+        flag.clear()
+
+
+class AsyncBluetoothLEConnection(BluetoothLEConnection):
+
+    def __init__(self, dev_id=0, transport=None, high_speed=False, warm=False, firmware=None, irq=True):
+        super().__init__(dev_id, transport, high_speed, warm, firmware)
+        self.data_flag = Flag()
+        self.complete_flag = asyncio.Event()
+        self.listeners = []
+        self.reader_task = None
+        if irq:
+            self.user_socket.enable_irq(self.data_flag.set)
+
+    # callback is an async function taking the packet - it runs as its own task
+    def listen(self, callback):
+        self.listeners.append(callback)
+
+    def start(self):
+        if self.reader_task is None:
+            self.reader_task = asyncio.create_task(self.reader())
+
+    async def stop(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+
+    async def reader(self):
+        while True:
+            if self.readable():
+                self.receive_all()
+                await asyncio.sleep(0)
+            else:
+                await wait_flag(self.data_flag, POLL_MS)
+
+    def on_data(self, data):
+        super().on_data(data)
+        for callback in self.listeners:
+            asyncio.create_task(callback(data))
+
+    def command_done(self, opcode, credits, status, return_parameters=b''):
+        super().command_done(opcode, credits, status, return_parameters)
+        self.complete_flag.set()
+
+    async def send_command_packet(self, opcode, data, timeout=COMMAND_TIMEOUT):
+        self.start()
+        hci_command = self.issue_packet(opcode, data)
+        if self.pipelined:
+            return hci_command
+        return await self.wait_command(hci_command, timeout)
+
+    async def wait_command(self, hci_command, timeout=COMMAND_TIMEOUT):
+        await self.wait_until(lambda: hci_command.done, timeout)
+        if not hci_command.done:
+            self.abandon_command(hci_command)
+        return hci_command
+
+    async def wait_commands(self, timeout=COMMAND_TIMEOUT):
+        await self.wait_until(lambda: self.commands_outstanding() == 0, timeout)
+        late = self.command_queue + [c for w in self.pending_commands.values() for c in w]
+        for hci_command in late:
+            self.abandon_command(hci_command)
+        return not late
+
+    async def wait_until(self, test, timeout):
+        self.start()
+        self.data_flag.set()                         # let the reader look for the reply at once
+        end = ticks_add(ticks_ms(), int(timeout * 1000))
+        while not test():
+            remaining = ticks_diff(end, ticks_ms())
+            if remaining <= 0:
+                return
+            self.complete_flag.clear()
+            if not self.flush():                     # the H2BT buffer was full - try again soon
+                remaining = min(remaining, POLL_MS)
+            await wait_flag(self.complete_flag, remaining)
+
+    async def do_start_advertising(self, data, scan_response_data=b'', adv_type=0x00,
+                                   min_interval=0x00a0, max_interval=0x00a0):
+        pipelined = self.pipelined
+        self.pipelined = True
+        commands = [await self.do_set_advertise_enable(False),
+                    await self.do_set_advertising_parameters(adv_type, min_interval=min_interval,
+                                                             max_interval=max_interval),
+                    await self.do_set_advertising_data(data),
+                    await self.do_set_scan_response_data(scan_response_data),
+                    await self.do_set_advertise_enable(True)]
+        self.pipelined = pipelined
+        await self.wait_commands(COMMAND_TIMEOUT)
+        return all(c.succeeded() for c in commands)
+
+    async def wait_listen(self, timeout = DATA_TIMEOUT):
+        self.start()
+        await asyncio.sleep(timeout)
@@ -0,0 +1,105 @@
+# Boot time benchmark
+#
+# Does a cold boot and reports the time, gSPI transactions and bytes of each setup() phase
+# (see boot_phase() in cyw.py), then compares them with a stored baseline:
+#
+#     import boot_bench
+#     boot_bench.run()                                   # compare with boot_baseline.json
+#     boot_bench.run(PIOTransport(), save=True)          # store this run as the new baseline
+#
+# The report is also written as JSON to boot_report.json:
+#     {"transport": ..., "high_speed": ..., "total_us": ..., "transactions": ..., "bytes": ...,
+#      "window_switches": ...,
+#      "phases": [{"name": ..., "us": ..., "transactions": ..., "bytes": ..., "window_switches": ...}, ...]}
+#
+# A phase is a regression if it now takes more than tolerance (a fraction) plus slack_us longer
+# than in the baseline, or uses more transactions, bytes or backplane window switches.
+# sim/bench_boot.py runs the same benchmark on a host against the simulated chip.
+
+import json
+from cyw import CYW, boot_report
+
+REPORT_FILE   = "boot_report.json"
+BASELINE_FILE = "boot_baseline.json"
+
+
+def make_report(transport, high_speed):
+    phases = boot_report()
+    return {"transport": transport.__class__.__name__ if transport else "SoftSPITransport",
+            "high_speed": high_speed,
+            "total_us": sum(p["us"] for p in phases),
+            "transactions": sum(p["transactions"] for p in phases),
+            "bytes": sum(p["bytes"] for p in phases),
+            "window_switches": sum(p["window_switches"] for p in phases),
+            "phases": phases}
+
+
+def print_report(report):
+    print("---- Boot: {} us, {} transactions, {} bytes ({}{})".format(
+          report["total_us"], report["transactions"], report["bytes"],
+          report["transport"], ", HIGH_SPEED" if report["high_speed"] else ""))
+    print("{:12} {:>10} {:>8} {:>10} {:>8}".format("Phase", "us", "trans", "bytes", "windows"))
+    for p in report["phases"]:
+        print("{:12} {:10} {:8} {:10} {:8}".format(p["name"], p["us"], p["transactions"], p["bytes"],
+                                                   p["window_switches"]))
+
+
+# Returns a list of (phase, field, baseline value, new value) for each regression
+def compare(report, baseline, tolerance=0.1, slack_us=1000):
+    regressions = []
+    old_phases = {}
+    for p in baseline["phases"]:
+        old_phases[p["name"]] = p
+    for p in report["phases"]:
+        old = old_phases.get(p["name"])
+        if old is None:
+            continue
+        if p["us"] > old["us"] * (1 + tolerance) + slack_us:
+            regressions.append((p["name"], "us", old["us"], p["us"]))
+        for field in ("transactions", "bytes", "window_switches"):
+            if field in old and p[field] > old[field]:
+                regressions.append((p["name"], field, old[field], p[field]))
+    return regressions
+
+
+def print_comparison(report, baseline, regressions):
+    print("---- Against baseline: {} us -> {} us, {} -> {} transactions".format(
+          baseline["total_us"], report["total_us"], baseline["transactions"], report["transactions"]))
+    for name, field, old, new in regressions:
+        print("**** Regression: {} {} {} -> {}".format(name, field, old, new))
+
+
+def save_json(name, data):
+    with open(name, "w") as f:
+        json.dump(data, f)
+
+
+def load_json(name):
+    try:
+        with open(name) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def run(transport=None, high_speed=False, firmware=None, baseline=BASELINE_FILE, save=False,
+        tolerance=0.1, slack_us=1000, report_file=REPORT_FILE):
+    cyw = CYW(transport, high_speed, firmware=firmware)
+    report = make_report(transport, high_speed)
+    cyw.close()
+
+    print_report(report)
+    save_json(report_file, report)
+
+    regressions = []
+    if save:
+        save_json(baseline, report)
+        print("---- Saved as baseline", baseline)
+    else:
+        old = load_json(baseline)
+        if old is None:
+            print("---- No baseline", baseline)
+        else:
+            regressions = compare(report, old, tolerance, slack_us)
+            print_comparison(report, old, regressions)
+    return report, regressions
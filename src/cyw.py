@@ -1,13 +1,12 @@
 from machine import Pin
-from time import sleep_ms, sleep_us
-import rp2
+import io
+import os
+from time import sleep_ms, ticks_ms, ticks_us, ticks_diff
+from gspi import SoftSPITransport, BitBashTransport, PIOTransport, LoopbackTransport
+from log import log, TRANSPORT, ERROR
 
-cs  = Pin(25, Pin.OUT)
-clk = Pin(29, Pin.OUT)
 pwr = Pin(23, Pin.OUT)
 
-TIMING_DELAY = 1
-
 # Constants for WIFI chip
 
 # gSPI command structure (CW43439 Datasheet 002-30348 Rev *B page 19)
@@ -150,6 +149,20 @@ SEND_HEAD                = 0x2000
 SEND_TAIL                = 0x2004
 RECEIVE_HEAD             = 0x2008
 RECEIVE_TAIL             = 0x200c
+
+# Both buffers are circular. Head == tail means empty, so the head is never allowed to catch up with
+# the tail - there are always RING_GAP bytes free.
+# The BT2H buffer counts as full if there is no room left for the largest HCI event (255 bytes of
+# parameters, event code, length and type, plus the 3 byte length prefix and padding).
+
+RING_SIZE                = 0x1000
+RING_MASK                = RING_SIZE - 1
+RING_GAP                 = 4
+RING_RX_FULL             = RING_SIZE - RING_GAP - 264
+
+SEND_TIMEOUT_MS          = 1000
+
+
 # SUPPPORTING FUNCTIONS
 
 # Hex printing functions
@@ -212,7 +225,11 @@ def print_hex_val_u32(title, val):
 # Chip power on and off using PWR pin (GPIO 23)
 
 def power_on():
-    clk.value(0)
+    reset_backplane_window()
+    shadow_invalidate()
+    cs_pin=Pin(25, Pin.OUT)
+    clk_pin=Pin(29, Pin.OUT)
+    clk_pin.value(0)
     data_pin=Pin(24, Pin.OUT)
     data_pin.value(0)
 
@@ -225,94 +242,189 @@ def power_off():
     pwr.value(0)
 
 # Core SPI data transmission
-from machine import SoftSPI
-
-
-# Normal SPI, not HIGH_SPEED
-def spi_transfer_softSPI(write, write_length, read_length):
-    cs.value(0)
-    spi = SoftSPI(baudrate=50000000, polarity=0, phase=0, sck=Pin(29), mosi=Pin(24), miso=Pin(24))
-    data_pin = Pin(24, Pin.OUT)  # because constructor makes it IN as its last IOCTL action
-    spi.write(write)
-    
-    new_read = b''
-    if read_length > 0:
-        data_pin = Pin(24, Pin.IN)
-        new_read = spi.read(read_length)
-        
-    cs.value(1)
-    return bytes(new_read)
-
-
-# SoftSPI rather than python bit-bashing, but customised for HIGH_SPEED
-
-# 01111101010110111111110111011010   Lost the first bit :-(
-# 10111110101011011111111011101101   BEAD FEED
+#
+# All gSPI transactions go through the selected transport (see gspi.py)
+# Register and backplane accesses use the transfer engine (bus), which keeps its own buffers
 
-def spi_transfer_softSPI_HIGH_SPEED(write, write_length, read_length):
-    cs.value(0)
-    spi = SoftSPI(baudrate=50_000_000, polarity=0, phase=0, sck=Pin(29), mosi=Pin(24), miso=Pin(24))
-    data_pin = Pin(24, Pin.OUT)  # because constructor makes it IN as its last IOCTL action
-    spi.write(write)
-    
-    new_read = b''
-    if read_length > 0:
-        data_pin = Pin(24, Pin.IN)
-        bit = data_pin.value()
-        read = spi.read(read_length)
-        new_read = b''
-        carry_in = bit
-        for b in read:
-            v = int(b)
-            carry_out = v & 1
-            v >>= 1
-            if carry_in:
-                v |= 128
-            carry_in = carry_out
-            new_read += bytes([v])
-        
-    cs.value(1)
-    return bytes(new_read)
+transport = None
+bus = None
 
-# Python bit-bashing SPI customised for HIGH_SPEED
+def set_transport(new_transport):
+    global transport, bus
+    new_transport.start()
+    transport = new_transport
+    bus = TransferEngine(new_transport)
 
-def spi_transfer_bit_bash__HIGH_SPEED(write, write_length, read_length):
-    clk.value(0)
-    cs.value(0)
-    data_pin = Pin(24, Pin.OUT)
-    read = bytearray()  # empty array
-   
-    for i in range(0, write_length):
-        byt = write[i]
-        mask = 128
-        while mask >= 1:
-           bit = 1 if byt & mask else 0
-           data_pin.value(bit)
-           clk.value(1)
-           sleep_us(TIMING_DELAY)
-           clk.value(0)
-           mask >>= 1
-    data_pin = Pin(24, Pin.IN)    
-
-    for i in range(0, read_length):
-        byt = 0
-        mask = 128
-        while mask >= 1:
-            bit = data_pin.value()
-            byt += mask if bit else 0
-            mask >>= 1
-            sleep_us(TIMING_DELAY)
-            clk.value(1)
-            sleep_us(TIMING_DELAY)
-            clk.value(0)
-        read.append(byt)
-    cs.value(1)
-    return bytes(read)
-
-
-# Select the one to use
 def spi_transfer(write, write_length, read_length):
-    return spi_transfer_softSPI(write, write_length, read_length)
+    bus.transactions += 1
+    bus.bytes += write_length + read_length
+    return transport.transfer(write, write_length, read_length)
+
+# Boot phases
+#
+# The cold boot marks the start of each phase with boot_phase(name), and the end of the last one
+# with boot_phase(None). boot_report() gives the time, gSPI transactions, bytes and backplane window
+# switches of each phase, see boot_bench.py.
+
+boot_phases = []
+
+def boot_phase(name):
+    boot_phases.append((name, ticks_us(), bus, bus.transactions if bus else 0, bus.bytes if bus else 0,
+                        backplane_window_switches))
+
+def boot_report():
+    phases = []
+    for i in range(0, len(boot_phases) - 1):
+        name, start, start_bus, start_transactions, start_bytes, start_windows = boot_phases[i]
+        _, end, end_bus, end_transactions, end_bytes, end_windows = boot_phases[i + 1]
+        if end_bus is not start_bus:                 # a new transfer engine, counting from zero
+            start_transactions = start_bytes = 0
+        phases.append({"name": name, "us": ticks_diff(end, start),
+                       "transactions": end_transactions - start_transactions,
+                       "bytes": end_bytes - start_bytes,
+                       "window_switches": end_windows - start_windows})
+    return phases
+
+# gSPI transfer engine
+#
+# Builds each transaction in preallocated buffers so register and backplane accesses do not allocate
+#     tx    command word followed by the data to write
+#     rx    backplane padding followed by the data read
+# A memoryview of each transfer length is made the first time that length is used and then kept
+# transactions and bytes count everything sent through it, including the command words
+
+MAX_TRANSFER = 512
+
+class TransferEngine:
+    def __init__(self, transport, size=MAX_TRANSFER):
+        self.transport = transport
+        self.size = size
+        self.tx = bytearray(4 + size)
+        self.rx = bytearray(BACKPLANE_PAD_VALUE + size)
+        self.tx_mv = memoryview(self.tx)
+        self.rx_mv = memoryview(self.rx)
+        self.tx_views = {}
+        self.rx_views = {}
+        self.data_views = {}
+        self.transactions = 0
+        self.bytes = 0
+
+    def tx_view(self, length):
+        view = self.tx_views.get(length)
+        if view is None:
+            view = self.tx_mv[0:length]
+            self.tx_views[length] = view
+        return view
+
+    def rx_view(self, length):
+        view = self.rx_views.get(length)
+        if view is None:
+            view = self.rx_mv[0:length]
+            self.rx_views[length] = view
+        return view
+
+    def data_view(self, pad, length):
+        key = (pad << 16) | length
+        view = self.data_views.get(key)
+        if view is None:
+            view = self.rx_mv[pad:pad + length]
+            self.data_views[key] = view
+        return view
+
+    # The command word of make_cmd(wr, 1, fn, addr, length), built a byte at a time - the word itself
+    # needs 32 bits, which is past MicroPython's small ints and would be allocated on every transfer
+    def set_cmd(self, wr, fn, addr, length):
+        tx = self.tx
+        tx[0] = length & 0xff
+        tx[1] = ((addr << 3) & 0xf8) | ((length >> 8) & 0x03)
+        tx[2] = (addr >> 5) & 0xff
+        tx[3] = (wr << 7) | 0x40 | (fn << 4) | ((addr >> 13) & 0x0f)
+
+    # Reads - the data is left in rx after the padding, rounded up to a word
+
+    def read_raw(self, fn, addr, length):
+        if length > self.size:
+            raise ValueError("gSPI read too long")
+        self.set_cmd(0, fn, addr, length)
+        pad = BACKPLANE_PAD_VALUE if fn == BACK_FUNC else 0
+        read_len = pad + ((length + 3) & ~3)
+        self.transport.write_readinto(self.tx_view(4), self.rx_view(read_len))
+        self.transactions += 1
+        self.bytes += 4 + read_len
+        return pad
+
+    # Returns a memoryview of the data, only valid until the next transfer
+    def read(self, fn, addr, length):
+        pad = self.read_raw(fn, addr, length)
+        return self.data_view(pad, length)
+
+    def readinto(self, fn, addr, buf):
+        length = len(buf)
+        pad = self.read_raw(fn, addr, length)
+        buf[0:length] = self.data_view(pad, length)
+
+    def read_reg(self, fn, addr, length):
+        pad = self.read_raw(fn, addr, length)
+        rx = self.rx
+        val = rx[pad]
+        if length > 1:
+            val |= rx[pad + 1] << 8
+        if length > 2:
+            val |= (rx[pad + 2] << 16) | (rx[pad + 3] << 24)
+        return val
+
+    # Writes - the transfer must be a full number of 32 bit words, so pad to the next 4 byte boundary
+
+    def write(self, fn, addr, val, length):
+        if length > self.size:
+            raise ValueError("gSPI write too long")
+        self.set_cmd(1, fn, addr, length)
+        tx = self.tx
+        if len(val) == length:
+            tx[4:4 + length] = val
+        else:
+            tx[4:4 + length] = memoryview(val)[0:length]
+        adjusted_len = (length + 3) & ~3
+        for i in range(4 + length, 4 + adjusted_len):
+            tx[i] = 0
+        self.transport.write_readinto(self.tx_view(4 + adjusted_len), None)
+        self.transactions += 1
+        self.bytes += 4 + adjusted_len
+
+    def write_reg(self, fn, addr, val, length):
+        self.set_cmd(1, fn, addr, length)
+        tx = self.tx
+        tx[4] = val & 0xff
+        tx[5] = (val >> 8) & 0xff
+        tx[6] = (val >> 16) & 0xff
+        tx[7] = (val >> 24) & 0xff
+        self.transport.write_readinto(self.tx_view(8), None)
+        self.transactions += 1
+        self.bytes += 8
+
+# gSPI trace
+#
+# start_trace() puts a TraceTransport (see gspi_trace.py) round the current transport so every
+# transaction is recorded, and stop_trace() takes it away again. Both return the recorder - its
+# save() writes a file for tools/trace_replay.py.
+# To trace a whole boot, pass the wrapped transport in instead: CYW(TraceTransport(SoftSPITransport()))
+
+def start_trace(size=1024):
+    global transport
+    from gspi_trace import TraceTransport
+    if not isinstance(transport, TraceTransport):
+        transport = TraceTransport(transport, size)
+        bus.transport = transport
+    return transport
+
+def stop_trace():
+    global transport
+    from gspi_trace import TraceTransport
+    tracer = transport
+    if isinstance(tracer, TraceTransport):
+        transport = tracer.inner
+        bus.transport = transport
+    return tracer
 
 # Data conversion and byte swapping
 # For swap_words, this changes the ordering from b0 b1 b2 b3 to b1 b0 b3 b2
@@ -379,117 +491,191 @@ def cyw_read_reg_u32_swap(fn, addr):
 # Register read functions - base function with length, the u8, u16 and u32 versions
 
 def cyw_read_bytes(fn, addr, length):
-    cmd = make_cmd(0, 1, fn, addr & 0x1ffff, length & 0x3ff)
-    cmd_bytes = u32_to_le_bytes(cmd)
-    pad = BACKPLANE_PAD_VALUE if fn == BACK_FUNC else 0
-    length = (length + 3) & ~3
-    read = spi_transfer(cmd_bytes, 4, length + pad)
-    print_hexline("Read  reg", cmd_bytes, read)
-    return read[pad:]
+    return bytes(bus.read(fn, addr, length))
 
 def cyw_write_bytes(fn, addr, val, length):
-    cmd = make_cmd(1, 1, fn, addr & 0x1ffff, length & 0x3ff)
-    cmd_bytes = u32_to_le_bytes(cmd)
-    # the transfer must be a full number of 32 bit words, so pad to the next 4 byte boundary
-    adjusted_len = (length + 3) & ~3       # round up
-    padding = bytes(adjusted_len - length) # bytes() of this length
-    data = cmd_bytes + val + padding
-    spi_transfer(data, 4 + (adjusted_len & 0x3ff), 0) # length of transfer is rounded up a word
-    print_hexline("Write reg", cmd_bytes, val)
+    bus.write(fn, addr, val, length)
 
 def cyw_read_reg_u8(fn, addr):
-    read = cyw_read_bytes(fn, addr, 1)
-    return le_bytes_to_u32(read[0:1])
+    return bus.read_reg(fn, addr, 1)
 
 def cyw_read_reg_u16(fn, addr):
-    read = cyw_read_bytes(fn, addr, 2)
-    return le_bytes_to_u32(read[0:2])
+    return bus.read_reg(fn, addr, 2)
 
 def cyw_read_reg_u32(fn, addr):
-    read = cyw_read_bytes(fn, addr, 4)
-    return le_bytes_to_u32(read[0:4])
+    return bus.read_reg(fn, addr, 4)
 
 # Register write functions - base function with length, the u8, u16 and u32 versions
 
 def cyw_write_reg_u8(fn, addr, val):
-    cyw_write_bytes(fn, addr, u32_to_le_bytes(val), 1)
+    bus.write_reg(fn, addr, val, 1)
 
 def cyw_write_reg_u16(fn, addr, val):
-    cyw_write_bytes(fn, addr, u32_to_le_bytes(val), 2)
+    bus.write_reg(fn, addr, val, 2)
     
 def cyw_write_reg_u32(fn, addr, val):
-    cyw_write_bytes(fn, addr, u32_to_le_bytes(val), 4)
+    bus.write_reg(fn, addr, val, 4)
 
 # Set backplane address (if different from previous value)
+#
+# The backplane window is the top 17 bits of the address, held in three byte registers at
+# BACKPLANE_LOW_REG, BACKPLANE_MED_REG and BACKPLANE_HIGH_REG. These are next to each other, so all
+# three are written in one 3 byte register write whenever the window changes.
+# The cached window is -1 when unknown - after power on or a core reset - so the next access sets it.
 
-backplane_prev_address_high = 0
-backplane_prev_address_med  = 0
-backplane_prev_address_low  = 0
+BACKPLANE_WINDOW_MASK = 0xff_ff_80_00
 
+backplane_window = -1
+backplane_window_switches = 0
 
-def set_backplane_address(addr):
-    global backplane_prev_address_high, backplane_prev_address_med, backplane_prev_address_low
-    # Could do logical and with mask of 0xff_ff_80_00 (same as ~0x7f_ff) but also just do that in the lines below
-    addr_high = (addr & 0xff_00_00_00) >> 24
-    addr_med  = (addr & 0x00_ff_00_00) >> 16
-    addr_low  = (addr & 0x00_00_80_00) >> 8
+def reset_backplane_window():
+    global backplane_window
+    backplane_window = -1
 
-    '''
-    if ((addr_high != backplane_prev_address_high) or
-        (addr_med  != backplane_prev_address_med ) or
-        (addr_low  != backplane_prev_address_low )):
-        print("++++ Backplane now 0x{0:08X}".format(addr & 0xff_ff_80_00))
-    '''
-    
-    if addr_high != backplane_prev_address_high:
-        cyw_write_reg_u8(BACK_FUNC, BACKPLANE_HIGH_REG, addr_high)
-        backplane_prev_address_high = addr_high
-    if addr_med != backplane_prev_address_med:
-        cyw_write_reg_u8(BACK_FUNC, BACKPLANE_MED_REG, addr_med)
-        backplane_prev_address_med = addr_med
-    if addr_low != backplane_prev_address_low:
-        cyw_write_reg_u8(BACK_FUNC, BACKPLANE_LOW_REG, addr_low)
-        backplane_prev_address_low = addr_low
+def set_backplane_address(addr):
+    global backplane_window, backplane_window_switches
+    window = addr & BACKPLANE_WINDOW_MASK
+    if window != backplane_window:
+        #print("++++ Backplane now 0x{0:08X}".format(window))
+        # low, med and high bytes in one write - address bit 15 is in low, 16-23 med, 24-31 high
+        bus.write_reg(BACK_FUNC, BACKPLANE_LOW_REG, window >> 8, 3)
+        backplane_window = window
+        backplane_window_switches += 1
 
-    
 # Register read and write for backplane - sets backplane address first
 
-def cyw_read_backplane_bytes(addr, length):
+def backplane_func_address(addr):
     set_backplane_address(addr)
-    addr &= 0x7f_ff
-    addr |= SBSDIO_SB_ACCESS_2_4B
-    read = cyw_read_bytes(BACK_FUNC, addr, length)
-    return read
+    return (addr & 0x7f_ff) | SBSDIO_SB_ACCESS_2_4B
+
+def cyw_read_backplane_bytes(addr, length):
+    return cyw_read_bytes(BACK_FUNC, backplane_func_address(addr), length)
 
 def cyw_write_backplane_bytes(addr, val, length):
-    set_backplane_address(addr)
-    addr &= 0x7f_ff
-    addr |= SBSDIO_SB_ACCESS_2_4B
-    cyw_write_bytes(BACK_FUNC, addr, val, length)
+    bus.write(BACK_FUNC, backplane_func_address(addr), val, length)
 
 # Register read and write for backplane - sets backplane address first
 
 def cyw_read_backplane_reg_u8(addr):
-    read = cyw_read_backplane_bytes(addr, 1)
-    return le_bytes_to_u32(read[0:1])
+    return bus.read_reg(BACK_FUNC, backplane_func_address(addr), 1)
 
 def cyw_read_backplane_reg_u16(addr):
-    read = cyw_read_backplane_bytes(addr, 2)
-    return le_bytes_to_u32(read[0:2])
+    return bus.read_reg(BACK_FUNC, backplane_func_address(addr), 2)
 
 def cyw_read_backplane_reg_u32(addr):
-    read = cyw_read_backplane_bytes(addr, 4)
-    return le_bytes_to_u32(read[0:4])
+    return bus.read_reg(BACK_FUNC, backplane_func_address(addr), 4)
 
 
 def cyw_write_backplane_reg_u8(addr, val):
-    cyw_write_backplane_bytes(addr, u32_to_le_bytes(val), 1)
+    bus.write_reg(BACK_FUNC, backplane_func_address(addr), val, 1)
 
 def cyw_write_backplane_reg_u16(addr, val):
-    cyw_write_backplane_bytes(addr, u32_to_le_bytes(val), 2)
+    bus.write_reg(BACK_FUNC, backplane_func_address(addr), val, 2)
     
 def cyw_write_backplane_reg_u32(addr, val):
-    cyw_write_backplane_bytes(addr, u32_to_le_bytes(val), 4)
+    bus.write_reg(BACK_FUNC, backplane_func_address(addr), val, 4)
+
+# Shadow registers
+#
+# Some backplane registers are used over and over by the BT routines, so a copy of each is kept here
+# with a policy for when the chip has to be read again:
+#     SHADOW_WRITE_THROUGH    only the host changes it - read once, then every write goes to the chip
+#                             and the shadow, so a read-modify-write needs no bus read
+#     SHADOW_TTL              the chip changes it - a value read is reused for SHADOW_TTL_MS, or until
+#                             shadow_invalidate()
+# All shadows are dropped by power_on(), warm_attach() and reset_core(). Hits and misses are counted.
+
+SHADOW_WRITE_THROUGH = 0
+SHADOW_TTL           = 1
+
+SHADOW_TTL_MS        = 10
+
+shadow_policy = {HOST_CONTROL_REG: SHADOW_WRITE_THROUGH,
+                 BT_CONTROL_REG:   SHADOW_TTL}
+shadow_values = {}
+shadow_times = {}
+shadow_hits = 0
+shadow_misses = 0
+
+def shadow_invalidate(addr=None):
+    if addr is None:
+        shadow_values.clear()
+    elif addr in shadow_values:
+        del shadow_values[addr]
+
+def shadow_read_u32(addr):
+    global shadow_hits, shadow_misses
+    if addr in shadow_values:
+        if shadow_policy[addr] == SHADOW_WRITE_THROUGH or ticks_diff(ticks_ms(), shadow_times[addr]) < SHADOW_TTL_MS:
+            shadow_hits += 1
+            return shadow_values[addr]
+    shadow_misses += 1
+    val = cyw_read_backplane_reg_u32(addr)
+    shadow_values[addr] = val
+    shadow_times[addr] = ticks_ms()
+    return val
+
+def shadow_write_u32(addr, val):
+    cyw_write_backplane_reg_u32(addr, val)
+    if shadow_policy[addr] == SHADOW_WRITE_THROUGH:
+        shadow_values[addr] = val
+    else:
+        shadow_invalidate(addr)
+
+def shadow_stats():
+    return {"hits": shadow_hits, "misses": shadow_misses}
+
+# Backplane access batches
+#
+# Queue a group of independent backplane register reads and writes, then run() them grouped by
+# window so the window is switched as few times as possible. The window already set goes first,
+# then the others in the order they were first used. Accesses in the same window keep their order.
+# run() returns the values read, in the order the reads were queued.
+#
+# Only queue accesses that do not depend on each other - a read queued after a write to a different
+# window may run before it.
+
+class BackplaneBatch:
+    def __init__(self):
+        self.ops = []
+
+    def read_u8(self, addr):
+        self.ops.append((addr, 1, None))
+
+    def read_u16(self, addr):
+        self.ops.append((addr, 2, None))
+
+    def read_u32(self, addr):
+        self.ops.append((addr, 4, None))
+
+    def write_u8(self, addr, val):
+        self.ops.append((addr, 1, val))
+
+    def write_u16(self, addr, val):
+        self.ops.append((addr, 2, val))
+
+    def write_u32(self, addr, val):
+        self.ops.append((addr, 4, val))
+
+    def run(self):
+        windows = [backplane_window]
+        for addr, length, val in self.ops:
+            window = addr & BACKPLANE_WINDOW_MASK
+            if window not in windows:
+                windows.append(window)
+
+        results = {}
+        for window in windows:
+            for i in range(0, len(self.ops)):
+                addr, length, val = self.ops[i]
+                if addr & BACKPLANE_WINDOW_MASK != window:
+                    continue
+                if val is None:
+                    results[i] = bus.read_reg(BACK_FUNC, backplane_func_address(addr), length)
+                else:
+                    bus.write_reg(BACK_FUNC, backplane_func_address(addr), val, length)
+        self.ops = []
+        return [results[i] for i in sorted(results)]
 
 # Controlling the cores
 
@@ -511,6 +697,8 @@ def check_core(core):
         
 def reset_core(core):
     core_base, core_name = core_address(core)
+    reset_backplane_window()
+    shadow_invalidate()
     
     cyw_write_backplane_reg_u8(core_base + AI_IOCTRL_OFFSET, SICF_FGC | SICF_CLOCK_EN)
     cyw_read_backplane_reg_u8(core_base + AI_IOCTRL_OFFSET)
@@ -520,72 +708,161 @@ def reset_core(core):
     cyw_read_backplane_reg_u8(core_base + AI_IOCTRL_OFFSET)
     sleep_ms(1)
 
-def check_core_up(core):
-    core_base, core_name = core_address(core)
-    
-    #print("---- Checking core", core_name) 
-    read = cyw_read_backplane_reg_u8(core_base + AI_IOCTRL_OFFSET)
-    if read & (SICF_FGC | SICF_CLOCK_EN) != SICF_CLOCK_EN:
-        print("**** Core", core_name, "not up")
-    read = cyw_read_backplane_reg_u8(core_base + AI_RESETCTRL_OFFSET)
-    if read & AIRC_RESET:
-        print("**** Core", core_name, "not up")
+# Check both cores in one batch - all four registers are in the same backplane window
 
-# Write firmware
-def write_firmware():
-    fw = open("fw.bin","rb")
-    
-    cyw43_fw_len = 231077
-    rounded_fw_len = 231080 # rounded to 4 byte boundary
-    cyw43_clm_len = 984
+def check_cores_up():
+    batch = BackplaneBatch()
+    for core in (CORE_WLAN, CORE_SOCSRAM):
+        core_base, core_name = core_address(core)
+        batch.read_u8(core_base + AI_IOCTRL_OFFSET)
+        batch.read_u8(core_base + AI_RESETCTRL_OFFSET)
+    wlan_ioctrl, wlan_resetctrl, socsram_ioctrl, socsram_resetctrl = batch.run()
 
-    address = 0x00_00_00_00
-    
-    # WIFI FW rounded to 512 bytes is 231424 (452 x 512)
-    # CLM is 984
-    # Total file size then 232408
+    if wlan_ioctrl & (SICF_FGC | SICF_CLOCK_EN) != SICF_CLOCK_EN or wlan_resetctrl & AIRC_RESET:
+        print("**** Core WLAN not up")
+    if socsram_ioctrl & (SICF_FGC | SICF_CLOCK_EN) != SICF_CLOCK_EN or socsram_resetctrl & AIRC_RESET:
+        print("**** Core SOCSRAM not up")
+
+# Firmware download pipeline
+#
+# An image is streamed from its file through one buffer that is reused for every image. The file is
+# read DOWNLOAD_BLOCK bytes at a time with readinto(), and each block goes to the chip as
+# BACKPLANE_BURST byte writes - the largest backplane transfer. The backplane window is only set
+# when the address crosses into the next 32 KB window.
+# Each image reports its size and bytes/second, and the figures are kept in download_stats.
+
+BACKPLANE_BURST = 64
+DOWNLOAD_BLOCK  = 1024                 # a multiple of BACKPLANE_BURST
+
+download_buf   = None
+download_views = None
+download_stats = {}
+
+def download_buffer():
+    global download_buf, download_views
+    if download_buf is None:
+        download_buf = bytearray(DOWNLOAD_BLOCK)
+        mv = memoryview(download_buf)
+        download_views = [mv[i:i + BACKPLANE_BURST] for i in range(0, DOWNLOAD_BLOCK, BACKPLANE_BURST)]
+    return download_buf
+
+def file_size(filename):
+    return os.stat(filename)[6]
 
-    remaining = rounded_fw_len
-    chunk_size = 64
+# Stream length bytes from file f to the backplane at address, returns the number of bytes written
+
+def stream_to_backplane(f, address, length):
+    buf = download_buffer()
+    mv = memoryview(buf)
+    remaining = length
 
     while remaining > 0:
-        if remaining < 16:
-            chunk_size = remaining
-        dat = fw.read(chunk_size)
-        cyw_write_backplane_bytes(address, dat, chunk_size)
-        #print(hex(address))
-        #dump_bytes_hex(address, dat)
-        address += chunk_size
-        remaining -= chunk_size
-    #print(hex(address))
+        if remaining >= DOWNLOAD_BLOCK:
+            block = f.readinto(buf)
+        else:
+            block = f.readinto(mv[0:remaining])
+        if not block:
+            print("**** File ended early")
+            break
+        offset = 0
+        while offset < block:
+            if address & BACKPLANE_WINDOW_MASK != backplane_window:
+                set_backplane_address(address)
+            # a burst must not cross the end of the window
+            burst = min(BACKPLANE_BURST, block - offset, 0x8000 - (address & 0x7f_ff))
+            if burst == BACKPLANE_BURST and offset & (BACKPLANE_BURST - 1) == 0:
+                data = download_views[offset // BACKPLANE_BURST]
+            else:
+                data = mv[offset:offset + burst]
+            bus.write(BACK_FUNC, (address & 0x7f_ff) | SBSDIO_SB_ACCESS_2_4B, data, burst)
+            address += burst
+            offset += burst
+        remaining -= block
+
+    return length - remaining
+
+def report_download(name, written, start):
+    elapsed = ticks_diff(ticks_us(), start)
+    rate = written * 1_000_000 // elapsed if elapsed > 0 else 0
+    download_stats[name] = (written, elapsed)
+    print("---- {}: {} bytes in {} ms, {} bytes/s".format(name, written, elapsed // 1000, rate))
+
+def download_image(name, f, address, length):
+    start = ticks_us()
+    written = stream_to_backplane(f, address, length)
+    report_download(name, written, start)
+    return written
+
+# Images held in memory
+#
+# Each image can also be a bytes object instead of a file name - normally from a firmware module
+# made by tools/fw_embed.py and frozen into the MicroPython build, so the data stays in flash.
+# Memoryview slices of it go straight to the transfer engine, with no file reads and no copies.
+
+def memory_to_backplane(data, address):
+    mv = memoryview(data)
+    length = len(mv)
+    offset = 0
+    while offset < length:
+        if address & BACKPLANE_WINDOW_MASK != backplane_window:
+            set_backplane_address(address)
+        burst = min(BACKPLANE_BURST, length - offset, 0x8000 - (address & 0x7f_ff))
+        bus.write(BACK_FUNC, (address & 0x7f_ff) | SBSDIO_SB_ACCESS_2_4B, mv[offset:offset + burst], burst)
+        address += burst
+        offset += burst
+    return length
+
+# Read from the backplane into a buffer (normally a memoryview), in bursts
+def backplane_to_memory(address, buf):
+    length = len(buf)
+    offset = 0
+    while offset < length:
+        if address & BACKPLANE_WINDOW_MASK != backplane_window:
+            set_backplane_address(address)
+        burst = min(BACKPLANE_BURST, length - offset, 0x8000 - (address & 0x7f_ff))
+        bus.readinto(BACK_FUNC, (address & 0x7f_ff) | SBSDIO_SB_ACCESS_2_4B, buf[offset:offset + burst])
+        address += burst
+        offset += burst
+    return length
+
+def download_memory(name, data, address):
+    start = ticks_us()
+    written = memory_to_backplane(data, address)
+    report_download(name, written, start)
+    return written
+
+# WLAN firmware
+# fw.bin is the firmware padded to 512 bytes (231077 padded to 231424), then the CLM (984 bytes)
+# The CLM is not needed for bluetooth so is not written - an image in memory has it removed already
+
+CYW43_CLM_LEN = 984
+
+def write_firmware(source="fw.bin"):
+    if not isinstance(source, str):
+        download_memory("fw", source, 0x00_00_00_00)
+        return
+    fw_len = file_size(source) - CYW43_CLM_LEN
+    fw = open(source, "rb")
+    download_image(source, fw, 0x00_00_00_00, fw_len)
     fw.close()
 
-# Write firmware
-def write_nvram():
-    nvram = open("nvram.bin","rb")
-    
-    nvram_len = 743
-    rounded_nvram_len = 744 # rounded to 4 byte boundary
+# NVRAM - placed at the top of RAM, below a magic word holding its length in words
+
+def write_nvram(source="nvram.bin"):
+    in_memory = not isinstance(source, str)
+    nvram_len = len(source) if in_memory else file_size(source)
+    rounded_nvram_len = (nvram_len + 3) & ~3  # rounded to 4 byte boundary
 
     top_of_ram_address = 0x00_08_00_00 # 512 * 1204 - top of ram
     magic_address = top_of_ram_address - 4 # place for the magic
     nvram_address = magic_address - rounded_nvram_len
-   
-    address = nvram_address
-    #block_size = 16
-    remaining = rounded_nvram_len
-    #chunk_size = 16
-    chunk_size = 64
-    while remaining > 0:
-        if remaining < chunk_size:
-            chunk_size = remaining
-        dat = nvram.read(chunk_size)
-        cyw_write_backplane_bytes(address, dat, chunk_size)
-        #dump_bytes_hex(address, dat)
-        address += chunk_size
-        remaining -= chunk_size
-    #print(hex(address))
-    nvram.close()
+
+    if in_memory:
+        download_memory("nvram", source, nvram_address)          # last write is padded to a word
+    else:
+        nvram = open(source, "rb")
+        download_image(source, nvram, nvram_address, nvram_len)
+        nvram.close()
     
     # One way to calculate the magic number
     nvram_words = rounded_nvram_len >> 2
@@ -594,9 +871,91 @@ def write_nvram():
         
     #magic  = ((~(rounded_nvram_len >> 2) & 0xffff) << 16) | (rounded_nvram_len >> 2) 
     #print("Magic is ", hex(magic))
-    cyw_write_backplane_bytes(magic_address, u32_to_le_bytes(magic), 4)
+    cyw_write_backplane_reg_u32(magic_address, magic)
+
+# Bluetooth firmware
+#
+# Either the raw record file (btfw.bin) or an image made from it by tools/btfw_convert.py (btfw.img).
+# The image is just the data to write, as segments already merged and padded to whole words, so it
+# is streamed straight to the backplane with no record parsing:
+#   4 bytes     Magic - 00 'B' 'T' 'I' (a raw file never has a zero length version string)
+#   1 byte      Number of bytes in version string
+#   n bytes     Version string
+#   4 bytes     Number of segments
+#       4 bytes     Address (offset from BTFW_MEM_OFFSET)
+#       4 bytes     Length, a multiple of 4
+#       n bytes     Data
+
+BTFW_IMAGE_MAGIC = b'\x00BTI'
+
+def write_bt_firmware(source=None):
+    if source is None:
+        try:
+            os.stat("btfw.img")
+            source = "btfw.img"
+        except OSError:
+            source = "btfw.bin"
+
+    start = ticks_us()
+    if not isinstance(source, str):
+        if source[0:4] == BTFW_IMAGE_MAGIC:
+            written = write_bt_firmware_image_memory(memoryview(source))
+        else:
+            written = write_bt_firmware_records(io.BytesIO(source))
+        report_download("btfw", written, start)
+        return
+
+    btfw = open(source, "rb")
+    if btfw.read(4) == BTFW_IMAGE_MAGIC:
+        written = write_bt_firmware_image(btfw)
+    else:
+        btfw.seek(0)
+        written = write_bt_firmware_records(btfw)
+    btfw.close()
+    report_download(source, written, start)
 
-# Bluetooth firmware - complex file structure
+def print_bt_firmware_version(ver):
+    print("Bluetooth firmware version: ", end="")
+    for c in ver:
+        print(chr(c), end="")
+    print()
+
+def write_bt_firmware_image(btfw):
+    data_in = btfw.read(1)
+    print_bt_firmware_version(btfw.read(data_in[0]))
+
+    header = bytearray(8)
+    btfw.readinto(memoryview(header)[0:4])
+    num_segs = le_bytes_to_u32(header[0:4])
+    print("Number of segments", num_segs)
+
+    written = 0
+    for i in range(0, num_segs):
+        btfw.readinto(header)
+        addr   = le_bytes_to_u32(header[0:4])
+        length = le_bytes_to_u32(header[4:8])
+        written += stream_to_backplane(btfw, BTFW_MEM_OFFSET + addr, length)
+    return written
+
+def write_bt_firmware_image_memory(mv):
+    ind = 4                                          # skip the magic
+    ver_len = mv[ind]
+    print_bt_firmware_version(mv[ind + 1:ind + 1 + ver_len])
+    ind += 1 + ver_len
+    num_segs = le_bytes_to_u32(mv[ind:ind + 4])
+    ind += 4
+    print("Number of segments", num_segs)
+
+    written = 0
+    for i in range(0, num_segs):
+        addr   = le_bytes_to_u32(mv[ind:ind + 4])
+        length = le_bytes_to_u32(mv[ind + 4:ind + 8])
+        ind += 8
+        written += memory_to_backplane(mv[ind:ind + length], BTFW_MEM_OFFSET + addr)
+        ind += length
+    return written
+
+# Bluetooth firmware raw file - complex file structure
 # The file is:
 #   1 byte      Number of bytes in version string
 #   n bytes     Version string
@@ -620,16 +979,11 @@ TYPE_ABSOLUTE_32BIT_ADDRESS = 5
 SPI_BUF_SIZE = 64
 
 
-def write_bt_firmware():
-    btfw = open("btfw.bin", "rb")
-
+def write_bt_firmware_records(btfw):
     data_in = btfw.read(1)
     ver_len = int(data_in[0])
     ver = btfw.read(ver_len)
-    print("Bluetooth firmware version: ", end="")
-    for c in ver:
-        print(chr(c), end="")
-    print()
+    print_bt_firmware_version(ver)
 
     data_in = btfw.read(1)
     num_recs = int(data_in[0])
@@ -642,6 +996,7 @@ def write_bt_firmware():
     buf_ind   = 0
     my_addr   = 0
     remaining_len = 0
+    written   = 0
 
     for i in range(0, num_recs):
         data_in   = btfw.read(4)
@@ -662,6 +1017,7 @@ def write_bt_firmware():
                     #print_hex("Buffer", buf)
 
                     cyw_write_backplane_bytes(BTFW_MEM_OFFSET + my_addr, bytes(buf), len(buf))
+                    written += len(buf)
                     
                     remaining_len = 0
                     buf = []
@@ -679,33 +1035,34 @@ def write_bt_firmware():
                     #print("Write address %8x size %4u"%(my_addr, buf_ind))
                     #print_hex("Buffer", buf)
                     cyw_write_backplane_bytes(BTFW_MEM_OFFSET + my_addr, bytes(buf), len(buf))
+                    written += len(buf)
                     buf_ind = 0
                     buf = []
                     my_addr += SPI_BUF_SIZE
                 to_copy = min(SPI_BUF_SIZE - buf_ind, remaining_len) 
-    btfw.close()
+    return written
 
 
 # BT routines
 
 def data_send_toggle():
-    val = cyw_read_backplane_reg_u32(HOST_CONTROL_REG)
+    val = shadow_read_u32(HOST_CONTROL_REG)
     val ^= DATA_VALID
-    cyw_write_backplane_reg_u32(HOST_CONTROL_REG, val)
+    shadow_write_u32(HOST_CONTROL_REG, val)
  
 def host_ready():
-    val = cyw_read_backplane_reg_u32(HOST_CONTROL_REG)
+    val = shadow_read_u32(HOST_CONTROL_REG)
     val |= SW_READY
-    cyw_write_backplane_reg_u32(HOST_CONTROL_REG, val)
+    shadow_write_u32(HOST_CONTROL_REG, val)
     
 def wake_bt():
-    val = cyw_read_backplane_reg_u32(HOST_CONTROL_REG)
+    val = shadow_read_u32(HOST_CONTROL_REG)
     new_val = val | WAKE_BT
     if new_val != val:
-        cyw_write_backplane_reg_u32(HOST_CONTROL_REG, new_val)
+        shadow_write_u32(HOST_CONTROL_REG, new_val)
 
 def is_bt_awake():
-    return cyw_read_backplane_reg_u32(BT_CONTROL_REG) & BT_AWAKE
+    return shadow_read_u32(BT_CONTROL_REG) & BT_AWAKE
 
 def wait_bt_awake():
     while not is_bt_awake():
@@ -713,7 +1070,7 @@ def wait_bt_awake():
         sleep_ms(500)
         
 def is_bt_ready():
-    return cyw_read_backplane_reg_u32(BT_CONTROL_REG) & FW_READY
+    return shadow_read_u32(BT_CONTROL_REG) & FW_READY
 
 def wait_bt_ready():
     while not is_bt_ready():
@@ -724,49 +1081,154 @@ def bus_request():
     wake_bt()
     wait_bt_ready()
 
+# HCI ring buffers
+# offset is the head (to write) or tail (to read), relative to the start of the ring at address
+
+def ring_used(head, tail):
+    return (head - tail) & RING_MASK
+
+def ring_free(head, tail):
+    return RING_SIZE - RING_GAP - ring_used(head, tail)
+
+def ring_write(address, offset, data):
+    length = len(data)
+    first = min(length, RING_SIZE - offset)
+    memory_to_backplane(data[0:first], address + offset)
+    if first < length:
+        memory_to_backplane(data[first:length], address)
+    return (offset + length) & RING_MASK
+
+def ring_read(address, offset, buf):
+    length = len(buf)
+    first = min(length, RING_SIZE - offset)
+    backplane_to_memory(address + offset, buf[0:first])
+    if first < length:
+        backplane_to_memory(address, buf[first:length])
+    return (offset + length) & RING_MASK
+
+# Split the contents of the BT2H buffer into HCI packets
+# Each packet is a 3 byte length (which excludes the HCI packet type byte), the packet, then padding
+# to a word boundary. A truncated packet at the end is dropped.
+
+def split_packets(dat):
+    packets = []
+    ind = 0
+    end = len(dat)
+    while ind + 4 <= end:
+        leng = dat[ind] | (dat[ind + 1] << 8) | (dat[ind + 2] << 16)
+        pkt_end = ind + 3 + leng + 1
+        if pkt_end > end:
+            break
+        packets.append(bytes(dat[ind + 3:pkt_end]))
+        ind = (pkt_end + 3) & ~3
+    return packets
+
+# Warm attach
+#
+# After a soft reset of the Pico the chip can still be powered and running its firmware, so there is
+# no need to power cycle it and load everything again. The chip is reused if:
+#     FEEDBEAD reads back - the gSPI is already configured (in the requested mode or the other one)
+#     BT_CONTROL_REG has FW_READY set
+#     WLAN_BASE_ADDRESS_REG holds the base of the BT shared memory
+#     the four HCI ring pointers at wifi_base are in range and word aligned
+# The HCI rings are then used as they are.
+# Nothing is written to chip memory to mark a cold boot - the BT firmware owns the shared memory
+# around the rings, and nothing documents any of it as free for the host.
+
+def rings_sane(wifi_base):
+    batch = BackplaneBatch()
+    for pointer in (SEND_HEAD, SEND_TAIL, RECEIVE_HEAD, RECEIVE_TAIL):
+        batch.read_u32(wifi_base + pointer)
+    for value in batch.run():
+        if value >= RING_SIZE or value & 3:
+            return False
+    return True
+
+# Returns the WLAN base address if the chip can be reused, otherwise None
+
+def warm_attach(high_speed=False):
+    reset_backplane_window()
+    shadow_invalidate()
+    for mode in (high_speed, not high_speed):
+        transport.set_high_speed(mode)
+        if check_spi_access():
+            break
+    else:
+        return None
+
+    if not is_bt_ready():
+        return None
+    wifi_base = cyw_read_backplane_reg_u32(WLAN_BASE_ADDRESS_REG)
+    if wifi_base == 0 or wifi_base == 0xffff_ffff or not rings_sane(wifi_base):
+        return None
+    return wifi_base
+
 # Setup WIFI and BT firmware and configuration
 
-def setup():
-    # Send empty bytes to clear 4-bit buffer
-    read = spi_transfer(b'\x00', 1, 0)  # Just to clear the 4bit extra needed
-    
-    # Set configuration
-    
-    # This is WITHOUT HIGH_SPEED so normal SPI works ok
-    config = WORD_LENGTH_32 | BIG_ENDIAN | INT_POLARITY_HIGH | WAKE_UP | INTR_WITH_STATUS
-    cyw_write_reg_u32_swap(SPI_FUNC, CONFIG_REG, config) 
-    sleep_ms(500)
-    
-    # Try to read FEEDBEAD
+# Set the gSPI configuration and check it by reading the FEEDBEAD test register
+# The chip boots in HIGH_SPEED mode with 16 bit words, so the configuration write uses the swapped form
+
+FEEDBEAD_VALUE = 0xFEED_BEAD
+TEST_PATTERN   = 0x1234_5678
+
+def check_spi_access():
     read = cyw_read_reg_u32(SPI_FUNC, FEEDBEAD_REG)
     print_hex_val_u32("---- SPI transfer read", read)
+    if read != FEEDBEAD_VALUE:
+        return False
+    # And a full word through the read/write test register
+    cyw_write_reg_u32(SPI_FUNC, TEST_REG, TEST_PATTERN)
+    return cyw_read_reg_u32(SPI_FUNC, TEST_REG) == TEST_PATTERN
 
-    '''
-    # This is WITH HIGH_SPEED so normal SPI does not work
-    # Try to read FEEDBEAD
-    read = cyw_read_reg_u32_swap(SPI_FUNC, FEEDBEAD_REG)
-    print_hex_val_u32("---- SPI transfer read", read)
-    
-    # Set configuration WITH HIGH_SPEED so need customised SPI
-    config = WORD_LENGTH_32 | BIG_ENDIAN | HIGH_SPEED | INT_POLARITY_HIGH | WAKE_UP | INTR_WITH_STATUS
+def setup_spi(high_speed):
+    config = WORD_LENGTH_32 | BIG_ENDIAN | INT_POLARITY_HIGH | WAKE_UP | INTR_WITH_STATUS
+    if high_speed:
+        config |= HIGH_SPEED
     cyw_write_reg_u32_swap(SPI_FUNC, CONFIG_REG, config) 
+    transport.set_high_speed(high_speed)
     sleep_ms(500)
-    '''
+
+    if check_spi_access():
+        return
+
+    if high_speed:
+        # Drop back to NORMAL mode - the chip is now in 32 bit mode so no swap is needed
+        print("**** HIGH_SPEED check failed, using NORMAL mode")
+        config &= ~HIGH_SPEED
+        cyw_write_reg_u32(SPI_FUNC, CONFIG_REG, config)
+        transport.set_high_speed(False)
+        sleep_ms(500)
+        if check_spi_access():
+            return
+    print("**** FEEDBEAD check failed")
+
+# firmware is a module with FW, NVRAM and BTFW bytes (see tools/fw_embed.py), or None to use the files
+
+def setup(high_speed=False, firmware=None):
+    # Send empty bytes to clear 4-bit buffer
+    boot_phase("config")
+    read = spi_transfer(b'\x00', 1, 0)  # Just to clear the 4bit extra needed
+    
+    # Set configuration - NORMAL mode, or HIGH_SPEED which the chip boots into
+    setup_spi(high_speed)
     
     # Set backplane read padding value
+    boot_phase("pad")
     cyw_write_reg_u8(SPI_FUNC, BACKPLANE_PAD_REG, BACKPLANE_PAD_VALUE)     
     
     # Clear interrupt bits
+    boot_phase("interrupts")
     config = DATA_UNAVAILABLE | COMMAND_ERROR | DATA_ERROR | F1_OVERFLOW
     cyw_write_reg_u16(SPI_FUNC, SPI_INT_REG, config)
     
-    # Enable specific interrupts
+    # Enable specific interrupts - F1_INTR carries the BT data ready interrupt to the host interrupt line
     config = F2_F3_FIFO_RD_UNDERFLOW | F2_F3_FIFO_WR_OVERFLOW | COMMAND_ERROR | DATA_ERROR | F2_PACKET_AVAILABLE | F1_OVERFLOW | F1_INTR
-    cyw_write_reg_u16(SPI_FUNC, SPI_INT_REG, config)    
+    cyw_write_reg_u16(SPI_FUNC, SPI_INT_ENABLE_REG, config)    
     
     # End of setup for SPI functions, now on to backplane resgister functions
     
     # Set ALP clock
+    boot_phase("alp_clock")
     cyw_write_reg_u8(BACK_FUNC, SDIO_CHIP_CLOCK_CSR, SBSDIO_ALP_AVAIL_REQ)
     
     # Set bluetooth watermark
@@ -786,6 +1248,7 @@ def setup():
     cyw_write_reg_u8(BACK_FUNC, SDIO_CHIP_CLOCK_CSR, 0)
    
     # Check device cores
+    boot_phase("core_reset")
     check_core(CORE_WLAN)
     check_core(CORE_SOCSRAM)
     
@@ -801,21 +1264,25 @@ def setup():
     print("---- Chip id:", read)
 
     # Write firmware
-    write_firmware()
+    boot_phase("firmware")
+    write_firmware(firmware.FW if firmware else "fw.bin")
 
     # Write nvram
-    write_nvram()
+    boot_phase("nvram")
+    write_nvram(firmware.NVRAM if firmware else "nvram.bin")
 
+    boot_phase("settle")
     sleep_ms(500)    
 
     # Reset WLAN core
+    boot_phase("wlan_reset")
     reset_core(CORE_WLAN)
 
     # Check cores up
-    check_core_up(CORE_WLAN)
-    check_core_up(CORE_SOCSRAM) 
+    check_cores_up()
 
     # Check for HT clock
+    boot_phase("ht_clock")
     read = cyw_read_reg_u8(BACK_FUNC, SDIO_CHIP_CLOCK_CSR)
     while (read & SBSDIO_HT_AVAIL) == 0:
         #print_hex_val_u8("---- HT AVAIL", read)
@@ -824,6 +1291,7 @@ def setup():
         read = cyw_read_reg_u8(BACK_FUNC, SDIO_CHIP_CLOCK_CSR)
     
     # Set interrupt mask
+    boot_phase("int_mask")
     cyw_write_backplane_reg_u32(SDIO_INT_HOST_MASK, I_HMB_SW_MASK);
     cyw_write_backplane_reg_u32(SDIO_INT_HOST_MASK, I_HMB_FC_CHANGE);
 
@@ -831,6 +1299,7 @@ def setup():
     cyw_write_reg_u8(BACK_FUNC, SDIO_FUNCTION2_WATERMARK, SPI_F2_WATERMARK)
 
     # Wait for F2 to be ready
+    boot_phase("f2_ready")
     read = cyw_read_reg_u8(SPI_FUNC, SPI_STATUS_REG)
     while (read & STATUS_F2_RX_READY) == 0:
         #print_hex_val_u8("---- F2 AVAIL", read)
@@ -839,6 +1308,7 @@ def setup():
         read = cyw_read_reg_u8(SPI_FUNC, SPI_STATUS_REG)
  
     # Change pad pull up
+    boot_phase("pull_up")
     cyw_write_reg_u8(BACK_FUNC, SDIO_PULL_UP, 0)
     read = cyw_read_reg_u8(BACK_FUNC, SDIO_PULL_UP)
     
@@ -848,57 +1318,226 @@ def setup():
         cyw_write_reg_u16(SPI_FUNC, SPI_INT_REG, status)
 
     # Load bluetooth firmware
+    boot_phase("bt_firmware")
     cyw_write_backplane_reg_u32(BTFW_MEM_OFFSET + BT2WLAN_PWRUP_ADDR, BT2WLAN_PWRUP_WAKE);
-    write_bt_firmware()
+    write_bt_firmware(firmware.BTFW if firmware else None)
 
     # Start bluetooth
+    boot_phase("bt_start")
     host_ready()
     bus_request()
     
 
 class CYW:
-    def __init__(self):
-        power_on()
-        setup()
-        self.wifi_base = cyw_read_backplane_reg_u32(WLAN_BASE_ADDRESS_REG)
+    # warm=True reuses the chip if it is still running from before a soft reset (see warm_attach)
+    # firmware is a module holding the firmware as bytes, see tools/fw_embed.py
+    # irq=True only checks for received data after the chip raises its host interrupt (see enable_irq)
+    def __init__(self, transport=None, high_speed=False, warm=False, firmware=None, irq=False):
+        start = ticks_ms()
+        self.irq_mode = False
+        self.irq_pending = False
+        self.irq_callback = None
+        self.irq_count = 0
+        self.idle_polls = 0
+        self.rx_queue = []
+        self.rx_drains = 0
+        self.rx_packets = 0
+        self.rx_buf = bytearray(RING_SIZE)
+        self.rx_buf_mv = memoryview(self.rx_buf)
+        self.tx_high_water = 0
+        self.tx_stalls = 0
+        self.tx_writes = 0
+        self.tx_packets = 0
+        self.rx_high_water = 0
+        self.rx_stalls = 0
+        if transport is None:
+            transport = SoftSPITransport()
+        self.transport = transport
+
+        self.wifi_base = None
+        if warm:
+            set_transport(transport)
+            self.wifi_base = warm_attach(high_speed)
+
+        if self.wifi_base is not None:
+            self.warm = True
+            self.boot_ms = ticks_diff(ticks_ms(), start)
+            print("---- Warm attach in {} ms".format(self.boot_ms))
+        else:
+            self.warm = False
+            boot_phases.clear()
+            boot_phase("power_on")
+            power_on()
+            set_transport(transport)
+            setup(high_speed, firmware)
+            boot_phase("wifi_base")
+            self.wifi_base = cyw_read_backplane_reg_u32(WLAN_BASE_ADDRESS_REG)
+            boot_phase(None)
+            self.boot_ms = ticks_diff(ticks_ms(), start)
+            print("---- Cold boot in {} ms".format(self.boot_ms))
         print_hex_val_u32("WIFI Base", self.wifi_base)
+        if irq:
+            self.enable_irq()
         
     def close(self):
         power_off()
 
-    def send_raw(self, dat):
+    # Send HCI packets - each has a 3 byte length prefix (excluding the HCI packet type byte), the
+    # packet, then padding to make it word aligned
+    # send_packets() packs a batch into one H2BT write, so the head is moved and DATA_VALID toggled
+    # once for the whole batch - a batch bigger than the buffer goes in as few writes as fit.
+    # If the H2BT buffer is full, wait for the controller to make room when block is True (giving
+    # up after SEND_TIMEOUT_MS), otherwise stop there ("would block").
+    # send_packets() returns how many packets, from the front, were written - send_raw() True or False
+
+    def send_raw(self, dat, block=True):
+        return self.send_packets((dat,), block) == 1
+
+    def send_packets(self, packets, block=True):
+        count = len(packets)
+        sent = 0
+        while sent < count:
+            size = 0
+            end = sent
+            while end < count:
+                padded = (len(packets[end]) + 6) & ~3
+                if end > sent and size + padded > RING_SIZE - RING_GAP:
+                    break
+                size += padded
+                end += 1
+            buf = bytearray(size)
+            ind = 0
+            for i in range(sent, end):
+                dat = packets[i]
+                leng = len(dat)
+                buf[ind:ind + 3] = u32_to_le_bytes(leng - 1)[0:3]
+                buf[ind + 3:ind + 3 + leng] = dat
+                ind += (leng + 6) & ~3
+            if not self.write_h2bt(buf, block):
+                break
+            self.tx_packets += end - sent
+            sent = end
+        return sent
+
+    def write_h2bt(self, buf, block=True):
         base = self.wifi_base
-        # need to add prefix of 3 bytes of length and padding at end to make this word aligned
-        size = len(dat)
-        length_bytes = u32_to_le_bytes(size - 1)[0:3]  # length (excluding the HCI command byte), trimmed to three bytes
-        size += 3                                      # add length of the length_bytes
-        adjusted_size = (size + 3) & ~3                # round up 
-        padding = bytes(adjusted_size - size)          # bytes() of padding
-    
-        buf = length_bytes + dat + padding             # length prefix + data + padding
-        buf_len = len(buf)
-    
+        length = len(buf)
+        if length > RING_SIZE - RING_GAP:
+            raise ValueError("HCI write of {} bytes is larger than the H2BT buffer".format(length))
+
         send_head = cyw_read_backplane_reg_u32(base + SEND_HEAD)
         send_tail = cyw_read_backplane_reg_u32(base + SEND_TAIL)
-    
-        cyw_write_backplane_bytes(base + H2BT_BUFFER + send_head, buf, buf_len)
-        cyw_write_backplane_reg_u32(base + SEND_HEAD, send_tail + buf_len)
+        if ring_free(send_head, send_tail) < length:
+            self.tx_stalls += 1
+            if not block:
+                return False
+            start = ticks_ms()
+            while ring_free(send_head, send_tail) < length:
+                if ticks_diff(ticks_ms(), start) > SEND_TIMEOUT_MS:
+                    log(TRANSPORT, ERROR, "H2BT buffer full")
+                    return False
+                sleep_ms(1)
+                send_tail = cyw_read_backplane_reg_u32(base + SEND_TAIL)
+
+        used = ring_used(send_head, send_tail) + length
+        if used > self.tx_high_water:
+            self.tx_high_water = used
+        send_head = ring_write(base + H2BT_BUFFER, send_head, buf)
+        cyw_write_backplane_reg_u32(base + SEND_HEAD, send_head)
         data_send_toggle()
-
-    def receive_raw(self):
+        self.tx_writes += 1
+        return True
+
+    # Drain the BT2H buffer
+    #
+    # The controller can queue several HCI packets before we look, each with its own 3 byte length
+    # header and padding. receive_packets() reads everything between tail and head in one backplane
+    # read, splits it into packets and moves the tail once.
+    # receive_raw() returns one packet at a time, keeping the rest in rx_queue for the next call, and
+    # receive_packets() returns anything left in rx_queue first.
+
+    def receive_packets(self):
+        packets = self.rx_queue
+        self.rx_queue = []
         base = self.wifi_base
         receive_head = cyw_read_backplane_reg_u32(base + RECEIVE_HEAD)
         receive_tail = cyw_read_backplane_reg_u32(base + RECEIVE_TAIL)
-
-        dat = cyw_read_backplane_bytes(base + BT2H_BUFFER + receive_tail, receive_head - receive_tail)
-        #data_send_toggle() 
+        if receive_head == receive_tail:
+            return packets
+
+        used = ring_used(receive_head, receive_tail)
+        if used > self.rx_high_water:
+            self.rx_high_water = used
+        if used > RING_RX_FULL:
+            self.rx_stalls += 1
+        dat = self.rx_buf_mv[0:used]
+        ring_read(base + BT2H_BUFFER, receive_tail, dat)
         cyw_write_backplane_reg_u32(base + RECEIVE_TAIL, receive_head) # move tail to head, clearing read buffer
         data_send_toggle()
-    
-        leng = le_bytes_to_u32(dat[0:3])     # get length from first 3 bytes
-        return dat[3:3 + leng + 1]           # trim off length 3 byte header and padding bytes trailer
+
+        received = split_packets(dat)
+        self.rx_drains += 1
+        self.rx_packets += len(received)
+        packets.extend(received)
+        return packets
+
+    def receive_raw(self):
+        if not self.rx_queue:
+            self.rx_queue = self.receive_packets()
+            if not self.rx_queue:
+                return b''
+        return self.rx_queue.pop(0)
+
+    # IRQ-armed receive
+    #
+    # While CS is high the chip drives the data line high when it has an interrupt pending - here
+    # when the BT firmware has put data in the BT2H buffer (I_HMB_FC_CHANGE, enabled by setup()).
+    # A rising edge sets irq_pending and calls callback, if given, to wake a waiter.
+    # Edges while CS is low are data bits, so the transport masks the pin interrupt for each
+    # transaction (see set_irq in gspi.py) - otherwise every 1 bit written or read would be a hard
+    # IRQ. An interrupt raised while masked is picked up from the line level, when the transport
+    # unmasks and in readable(), which costs no bus transaction. The CS check stays for an edge
+    # that lands just as CS goes low. The handler is a hard IRQ, so callback must not allocate
+    # (ThreadSafeFlag.set is fine).
+
+    def enable_irq(self, callback=None):
+        self.irq_callback = callback
+        self.irq_pending = True                      # check once for anything already waiting
+        self.irq_pin = self.transport.irq_pin()
+        self.irq_mode = True
+        self.transport.set_irq(self.on_irq)
+
+    def disable_irq(self):
+        if self.irq_mode:
+            self.transport.set_irq(None)
+            self.irq_mode = False
+
+    def on_irq(self, pin):
+        if self.transport.cs.value() == 0:
+            return
+        self.irq_count += 1
+        self.irq_pending = True
+        if self.irq_callback:
+            self.irq_callback()
+
+    # Ring occupancy telemetry - the most bytes seen in each buffer and how often it was full
+    # (a send that had to wait, or a drain that found the BT2H buffer full), plus the number of
+    # buffer writes and drains and the packets they carried
+    def ring_stats(self):
+        return {"tx_high_water": self.tx_high_water, "tx_stalls": self.tx_stalls,
+                "tx_writes": self.tx_writes, "tx_packets": self.tx_packets,
+                "rx_high_water": self.rx_high_water, "rx_stalls": self.rx_stalls,
+                "rx_drains": self.rx_drains, "rx_packets": self.rx_packets}
 
     def readable(self):
+        if self.rx_queue:
+            return True
+        if self.irq_mode:
+            if not self.irq_pending and not self.irq_pin.value():
+                self.idle_polls += 1
+                return False
+            self.irq_pending = False
+
         base = self.wifi_base
         read = cyw_read_backplane_reg_u32(SDIO_INT_STATUS);
         data_there = (read & I_HMB_FC_CHANGE != 0)
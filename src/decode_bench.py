@@ -0,0 +1,136 @@
+# HCI event decoding benchmark
+#
+# Times the decoding of an advertising report, a connection complete event and an ACL header,
+# the old way with the copying helpers (to_addr, to_data, to_bits_u16, ...) and the new way in
+# place with unpack_from and memoryview (see "In place decoding" in ble.py):
+#
+#     import decode_bench
+#     decode_bench.run()
+#
+# On MicroPython the garbage collector is held off while each case runs, and gc.mem_alloc() gives
+# the bytes allocated per event. CPython has no equivalent, so there only the times are shown.
+# sim/bench_decode.py runs it on a host.
+
+import gc
+from time import ticks_us, ticks_diff
+from ble import *
+
+ITERATIONS = 200
+
+ADVERTISING_REPORT = bytes([0x04, 0x3e, 0x1a, 0x02, 0x01, 0x00, 0x00,
+                            0x47, 0x84, 0x41, 0xdd, 0x3a, 0xd8, 0x0e,
+                            0x02, 0x01, 0x06, 0x0a, 0x09]) + b'SimDevice' + bytes([0xc8])
+
+CONNECTION_COMPLETE = bytes([0x04, 0x3e, 0x13, 0x01, 0x00, 0x40, 0x00, 0x00, 0x00,
+                             0x47, 0x84, 0x41, 0xdd, 0x3a, 0xd8,
+                             0x18, 0x00, 0x00, 0x00, 0x48, 0x00, 0x00])
+
+ACL_PACKET = bytes([0x02, 0x40, 0x20, 0x0e, 0x00, 0x0a, 0x00, 0x04, 0x00, 0x0b]) + b'SimDevice'
+
+
+# The old way - as the handlers decoded before
+
+def adv_copying(data):
+    count = 0
+    num_reports = to_u8(data, 4)
+    reports = to_data_rest(data, 5)
+    report_offset = 0
+    for rep in range(0, num_reports):
+        address =     to_addr (reports, report_offset+2)
+        data_len =    to_u8   (reports, report_offset+8)
+        report_data = to_data (reports, report_offset+9, data_len)
+        rssi =        to_u8   (reports, report_offset+9+data_len)
+        i = 0
+        while i < data_len:
+            entry_len = to_u8(report_data, i)
+            if entry_len > 0:
+                typ = to_u8  (report_data, i+1)
+                dat = to_data(report_data, i+2, entry_len-1)
+                count += len(dat)
+                i += entry_len
+            i += 1
+        report_offset += data_len+10
+    return count
+
+def connection_copying(data):
+    status = to_u8(data, 4)
+    handle = to_u16(data, 5)
+    address = to_addr(data, 9)
+    return handle
+
+def acl_copying(data):
+    handle = to_bits_u16(data, 1, 0, 12)
+    pb =     to_bits_u16(data, 1, 12, 2)
+    bc =     to_bits_u16(data, 1, 14, 2)
+    length = to_u16(data, 3)
+    size =     to_u16(data, 5)
+    channel =  to_u16(data, 7)
+    acl_data = to_data_rest(data, 9)
+    return len(acl_data)
+
+
+# The new way
+
+def adv_in_place(data):
+    count = 0
+    for event_type, address_type, address, report_data, rssi in le_advertising_reports(data):
+        data_len = len(report_data)
+        i = 0
+        while i < data_len:
+            entry_len = report_data[i]
+            if entry_len > 0:
+                typ = report_data[i+1]
+                dat = report_data[i+2: i+1+entry_len]
+                count += len(dat)
+                i += entry_len
+            i += 1
+    return count
+
+def connection_in_place(data):
+    status, handle = unpack_from("<BH", data, 4)
+    address = to_addr_int(data, 9)
+    return handle
+
+def acl_in_place(data):
+    flags, length = unpack_from("<HH", data, 1)
+    handle = flags & 0x0fff
+    pb =     (flags >> 12) & 0x03
+    bc =     flags >> 14
+    size, channel = unpack_from("<HH", data, 5)
+    acl_data = memoryview(data)[9: 5 + length]
+    return len(acl_data)
+
+
+CASES = (("adv report", ADVERTISING_REPORT, adv_copying, adv_in_place),
+         ("connection", CONNECTION_COMPLETE, connection_copying, connection_in_place),
+         ("acl header", ACL_PACKET, acl_copying, acl_in_place))
+
+
+# Returns (us, bytes allocated) per call - bytes is None if it can't be measured
+def measure(decode, data, iterations):
+    mem_alloc = getattr(gc, "mem_alloc", None)
+    gc.collect()
+    gc.disable()
+    before = mem_alloc() if mem_alloc else 0
+    start = ticks_us()
+    for i in range(0, iterations):
+        decode(data)
+    us = ticks_diff(ticks_us(), start)
+    after = mem_alloc() if mem_alloc else 0
+    gc.enable()
+    return us / iterations, (after - before) / iterations if mem_alloc else None
+
+
+def run(iterations=ITERATIONS):
+    results = []
+    print("{:12} {:>10} {:>10} {:>10} {:>10}".format("Event", "old us", "new us", "old bytes", "new bytes"))
+    for name, data, old, new in CASES:
+        if old(data) != new(data):
+            print("**** {}: decoders disagree".format(name))
+        old_us, old_bytes = measure(old, data, iterations)
+        new_us, new_bytes = measure(new, data, iterations)
+        results.append((name, old_us, new_us, old_bytes, new_bytes))
+        print("{:12} {:10.1f} {:10.1f} {:>10} {:>10}".format(name, old_us, new_us,
+              "-" if old_bytes is None else "{:.0f}".format(old_bytes),
+              "-" if new_bytes is None else "{:.0f}".format(new_bytes)))
+    return results
@@ -0,0 +1,444 @@
+# gSPI transports for the CYW43439
+#
+# The Pico W talks to the CYW43439 over a half-duplex SPI bus (gSPI) with a single shared data pin
+#     GPIO 24     data - MOSI and MISO (and the host interrupt line while CS is high)
+#     GPIO 25     CS
+#     GPIO 29     clock
+#
+# Every transaction has the same shape:
+#     CS low, write the command word (and any data), turn the data pin round, read any response, CS high
+#
+# A transport does just that - it knows nothing about command words, registers or the backplane.
+# Each transport provides:
+#
+#     start()                                       set up the bus once, called when the chip is powered
+#     write_readinto(write, read)                   one transaction - write all of write, then read
+#                                                   len(read) bytes into read (read may be None)
+#     transfer(write, write_length, read_length)    one transaction, returns read_length bytes
+#     set_high_speed(high_speed)                    match the clock edge the chip drives data on
+#     irq_pin()                                     a Pin for the data line, to take the host interrupt
+#     set_irq(handler)                              call handler(pin) when the chip raises its interrupt
+#
+# Between transactions the data pin is left as an input, because while CS is high the chip uses the
+# data line as its interrupt output (active high, see INT_POLARITY_HIGH in cyw.py).
+# Every 1 bit of a transaction is a rising edge on the same pin, so once set_irq() has armed it each
+# transport masks the pin interrupt while CS is low (mask_irq() and unmask_irq()). An interrupt raised
+# during a transaction has no edge to be seen by, so unmask_irq() checks the line level and calls the
+# handler itself if it is already high.
+#
+# write_readinto() is the main entry point and does not allocate, so the caller can keep its
+# buffers and pass memoryviews of them. transfer() is a convenience built on it.
+#
+# SoftSPITransport    MicroPython SoftSPI - the original code
+# BitBashTransport    Python bit-bashing, HIGH_SPEED timing only
+# PIOTransport        RP2040 PIO state machine doing write, turnaround and read in hardware
+# LoopbackTransport   pure python with no hardware - for testing the layers above on a host
+
+try:
+    from machine import Pin, SoftSPI
+except ImportError:                  # not on a Pico - only LoopbackTransport can be used
+    Pin = SoftSPI = None
+
+try:
+    import rp2
+except ImportError:
+    rp2 = None
+
+import time
+
+DATA_PIN = 24
+CS_PIN   = 25
+CLK_PIN  = 29
+
+TIMING_DELAY = 1
+
+
+# HIGH_SPEED bit realignment
+#
+# In HIGH_SPEED mode the chip drives each read bit on the rising edge, so SoftSPI (which samples on
+# the rising edge) misses the first bit and gets everything one bit early:
+#
+# 01111101010110111111110111011010   Lost the first bit :-(
+# 10111110101011011111111011101101   BEAD FEED
+#
+# The first bit is read from the pin before any clocks, then the buffer is shifted right by one bit
+# in place, in one pass
+
+def realign_read(buf, first_bit):
+    carry = 0x80 if first_bit else 0
+    for i in range(0, len(buf)):
+        v = buf[i]
+        buf[i] = carry | (v >> 1)
+        carry = (v & 1) << 7
+
+
+################################################################
+#
+# Base transport
+#
+################################################################
+
+class Transport:
+    high_speed = False
+    irq_handler = None
+
+    def start(self):
+        pass
+
+    def write_readinto(self, write, read):
+        raise NotImplementedError
+
+    def set_high_speed(self, high_speed):
+        self.high_speed = high_speed
+
+    # Pin(id) with no mode does not change the pin function, so this is safe with PIO too
+    def irq_pin(self):
+        return Pin(DATA_PIN)
+
+    # handler=None disarms the pin. The handler is a hard IRQ, so it must not allocate
+    def set_irq(self, handler):
+        self.irq_line = self.irq_pin()
+        self.irq_handler = handler
+        if handler:
+            self.unmask_irq()
+        else:
+            self.irq_line.irq(handler=None)
+
+    def mask_irq(self):
+        if self.irq_handler:
+            self.irq_line.irq(handler=None)
+
+    def unmask_irq(self):
+        handler = self.irq_handler
+        if handler:
+            line = self.irq_line
+            line.irq(handler=handler, trigger=line.IRQ_RISING, hard=True)
+            if line.value():
+                handler(line)
+
+    def transfer(self, write, write_length, read_length):
+        read = bytearray(read_length)
+        self.write_readinto(memoryview(write)[0:write_length], read if read_length > 0 else None)
+        return bytes(read)
+
+
+################################################################
+#
+# SoftSPI transport
+#
+# The SoftSPI object and the pins are made once in start(). The data pin is switched between
+# output and input for each transaction, because SoftSPI wants MOSI and MISO to be different pins.
+#
+################################################################
+
+class SoftSPITransport(Transport):
+    def __init__(self, baudrate=50_000_000):
+        self.baudrate = baudrate
+        self.high_speed = False
+
+    def start(self):
+        self.cs = Pin(CS_PIN, Pin.OUT, value=1)
+        self.spi = SoftSPI(baudrate=self.baudrate, polarity=0, phase=0,
+                           sck=Pin(CLK_PIN), mosi=Pin(DATA_PIN), miso=Pin(DATA_PIN))
+        self.data_pin = Pin(DATA_PIN, Pin.IN)
+
+    def irq_pin(self):
+        return self.data_pin
+
+    def write_readinto(self, write, read):
+        if self.high_speed:
+            self.write_readinto_high_speed(write, read)
+            return
+        self.mask_irq()
+        self.cs.value(0)
+        self.data_pin.init(Pin.OUT)
+        self.spi.write(write)
+        self.data_pin.init(Pin.IN)
+        if read:
+            self.spi.readinto(read)
+        self.cs.value(1)
+        self.unmask_irq()
+
+    # SoftSPI customised for HIGH_SPEED - pick up the first bit by hand, then realign
+
+    def write_readinto_high_speed(self, write, read):
+        self.mask_irq()
+        self.cs.value(0)
+        self.data_pin.init(Pin.OUT)
+        self.spi.write(write)
+        self.data_pin.init(Pin.IN)
+
+        if read:
+            bit = self.data_pin.value()
+            self.spi.readinto(read)
+            realign_read(read, bit)
+
+        self.cs.value(1)
+        self.unmask_irq()
+
+
+################################################################
+#
+# Python bit-bashing transport
+#
+# Each bit is sampled just before the rising edge, which works for both clock modes
+#
+################################################################
+
+class BitBashTransport(Transport):
+    def __init__(self):
+        self.high_speed = False
+
+    def start(self):
+        self.cs  = Pin(CS_PIN, Pin.OUT, value=1)
+        self.clk = Pin(CLK_PIN, Pin.OUT)
+        self.data_pin = Pin(DATA_PIN, Pin.IN)
+
+    def irq_pin(self):
+        return self.data_pin
+
+    def write_readinto(self, write, read):
+        clk = self.clk
+        data_pin = self.data_pin
+        clk.value(0)
+        self.mask_irq()
+        self.cs.value(0)
+        data_pin.init(Pin.OUT)
+
+        for i in range(0, len(write)):
+            byt = write[i]
+            mask = 128
+            while mask >= 1:
+               bit = 1 if byt & mask else 0
+               data_pin.value(bit)
+               clk.value(1)
+               time.sleep_us(TIMING_DELAY)
+               clk.value(0)
+               mask >>= 1
+        data_pin.init(Pin.IN)
+        if not read:
+            self.cs.value(1)
+            self.unmask_irq()
+            return
+
+        for i in range(0, len(read)):
+            byt = 0
+            mask = 128
+            while mask >= 1:
+                bit = data_pin.value()
+                byt += mask if bit else 0
+                mask >>= 1
+                time.sleep_us(TIMING_DELAY)
+                clk.value(1)
+                time.sleep_us(TIMING_DELAY)
+                clk.value(0)
+            read[i] = byt
+        self.cs.value(1)
+        self.unmask_irq()
+
+
+################################################################
+#
+# PIO transport
+#
+# The state machine drives the clock with side-set and uses the one data pin for out, set and in.
+# For each transaction the host pushes:
+#     number of bits to write - 1
+#     number of bits to read
+#     the bytes to write, one per FIFO word, MSB in bit 31
+# and gets back the bytes read, one per FIFO word, followed by a zero marker word once the
+# transaction has finished, so CS can be raised even when nothing is read.
+#
+# There is one program for each clock mode. In HIGH_SPEED mode the chip drives a read bit on the
+# rising edge, so the read loop samples on the falling edge instead and no realignment is needed.
+#
+################################################################
+
+if rp2:
+    @rp2.asm_pio(out_init=rp2.PIO.OUT_LOW, set_init=rp2.PIO.OUT_LOW, sideset_init=rp2.PIO.OUT_LOW,
+                 out_shiftdir=rp2.PIO.SHIFT_LEFT, in_shiftdir=rp2.PIO.SHIFT_LEFT,
+                 autopull=True, pull_thresh=8, autopush=True, push_thresh=8)
+    def gspi_pio_normal():
+        wrap_target()
+        pull()                  .side(0)    # bits to write - 1
+        out(x, 32)              .side(0)
+        pull()                  .side(0)    # bits to read
+        out(y, 32)              .side(0)
+        set(pindirs, 1)         .side(0)    # data pin is an output
+        label("write")
+        out(pins, 1)            .side(0)    # data changes while the clock is low
+        jmp(x_dec, "write")     .side(1)    # chip samples on the rising edge
+        set(pindirs, 0)         .side(0)    # turnaround - chip drives the first bit on this falling edge
+        jmp(not_y, "done")      .side(0)
+        jmp(y_dec, "read")      .side(0)
+        label("read")
+        in_(pins, 1)            .side(1)    # sample on the rising edge
+        jmp(y_dec, "read")      .side(0)
+        label("done")
+        in_(null, 8)            .side(0)    # marker word - transaction complete
+        wrap()
+
+    @rp2.asm_pio(out_init=rp2.PIO.OUT_LOW, set_init=rp2.PIO.OUT_LOW, sideset_init=rp2.PIO.OUT_LOW,
+                 out_shiftdir=rp2.PIO.SHIFT_LEFT, in_shiftdir=rp2.PIO.SHIFT_LEFT,
+                 autopull=True, pull_thresh=8, autopush=True, push_thresh=8)
+    def gspi_pio_high_speed():
+        wrap_target()
+        pull()                  .side(0)    # bits to write - 1
+        out(x, 32)              .side(0)
+        pull()                  .side(0)    # bits to read
+        out(y, 32)              .side(0)
+        set(pindirs, 1)         .side(0)    # data pin is an output
+        label("write")
+        out(pins, 1)            .side(0)
+        jmp(x_dec, "write")     .side(1)    # chip drives the first read bit on the last rising edge
+        set(pindirs, 0)         .side(1)    # turnaround - clock stays high
+        jmp(not_y, "done")      .side(1)
+        jmp(y_dec, "read")      .side(1)
+        label("read")
+        in_(pins, 1)            .side(0)    # sample on the falling edge
+        jmp(y_dec, "read")      .side(1)    # chip drives the next bit on the rising edge
+        label("done")
+        in_(null, 8)            .side(0)    # marker word - transaction complete
+        wrap()
+
+
+class PIOTransport(Transport):
+    def __init__(self, sm_id=0, freq=50_000_000):
+        self.sm_id = sm_id
+        self.freq = freq                     # two PIO cycles per bit, so the bus clock is freq / 2
+        self.high_speed = False
+
+    def start(self):
+        self.cs = Pin(CS_PIN, Pin.OUT, value=1)
+        self.sm = rp2.StateMachine(self.sm_id)
+        self.load_program()
+
+    def load_program(self):
+        program = gspi_pio_high_speed if self.high_speed else gspi_pio_normal
+        data_pin = Pin(DATA_PIN)
+        self.sm.active(0)
+        self.sm.init(program, freq=self.freq,
+                     out_base=data_pin, set_base=data_pin, in_base=data_pin,
+                     sideset_base=Pin(CLK_PIN))
+        self.sm.active(1)
+
+    def set_high_speed(self, high_speed):
+        if high_speed != self.high_speed:
+            self.high_speed = high_speed
+            self.load_program()
+
+    def write_readinto(self, write, read):
+        sm = self.sm
+        self.mask_irq()
+        self.cs.value(0)
+        sm.put(len(write) * 8 - 1)
+        sm.put(len(read) * 8 if read else 0)
+        sm.put(write, 24)
+        if read:
+            sm.get(read)
+        sm.get()                             # marker
+        self.cs.value(1)
+        self.unmask_irq()
+
+
+################################################################
+#
+# Loopback transport
+#
+# No hardware. Each transaction is passed to responder(write, read_length), which returns the bytes
+# read. With no responder the written bytes are echoed back, padded with zeros.
+# CS and the data line are LoopbackPins, and fire() on the data pin simulates the host interrupt.
+# If interrupt() is given it is called when CS goes high and returns the level of the device's
+# interrupt line, so the data pin follows it (see sim/cyw43_sim.py).
+# The command word and data raise the data pin while CS is low, as they do on the real bus, and
+# selected_irqs counts the times that edge found the pin interrupt armed. As on the rp2 port, a
+# handler set without hard=True is only run once the transaction is over.
+#
+################################################################
+
+class LoopbackPin:
+    IN  = 0
+    OUT = 1
+    IRQ_FALLING = 4
+    IRQ_RISING  = 8
+
+    def __init__(self, value=0):
+        self.level = value
+        self.handler = None
+        self.hard = False
+        self.scheduled = 0
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, value=None):
+        if value is None:
+            return self.level
+        self.level = value
+
+    def irq(self, handler=None, trigger=IRQ_RISING, hard=False):
+        self.handler = handler
+        self.hard = hard
+
+    # The chip raises the line
+    def fire(self):
+        self.level = 1
+        if self.handler:
+            if self.hard:
+                self.handler(self)
+            else:
+                self.scheduled += 1
+
+    # Run the soft handler calls that are waiting
+    def run_scheduled(self):
+        while self.scheduled:
+            self.scheduled -= 1
+            if self.handler:
+                self.handler(self)
+
+    # The chip drops the interrupt line
+    def clear(self):
+        self.level = 0
+
+
+class LoopbackTransport(Transport):
+    def __init__(self, responder=None, interrupt=None):
+        self.responder = responder
+        self.interrupt = interrupt
+        self.high_speed = False
+        self.transactions = 0
+        self.selected_irqs = 0
+        self.last_write = b''
+        self.cs = LoopbackPin(1)
+        self.data_pin = LoopbackPin(0)
+
+    def irq_pin(self):
+        return self.data_pin
+
+    def write_readinto(self, write, read):
+        self.transactions += 1
+        self.mask_irq()
+        self.cs.value(0)
+        write = bytes(write)
+        self.last_write = write
+        read_length = len(read) if read else 0
+        if self.responder:
+            data = self.responder(write, read_length)
+        else:
+            data = (write + bytes(read_length))[0:read_length]
+        if read_length > 0:
+            read[0:read_length] = data
+        last = data[read_length - 1] if read_length > 0 else write[-1]
+        if self.data_pin.handler:
+            self.selected_irqs += 1
+        self.data_pin.clear()                            # the bits written and read toggle the
+        self.data_pin.fire()                             # line while CS is low
+        self.data_pin.level = last & 1
+        self.cs.value(1)
+        if self.interrupt:
+            if not self.interrupt():
+                self.data_pin.clear()
+            elif not self.data_pin.level:
+                self.data_pin.fire()
+        self.unmask_irq()
+        self.data_pin.run_scheduled()
@@ -0,0 +1,114 @@
+# gSPI transaction trace
+#
+# TraceTransport wraps another transport (see gspi.py) and records every transaction into a fixed
+# size ring, so a boot or an HCI exchange can be traced with no allocation per transaction.
+# When the ring is full the oldest records are overwritten.
+#
+# Each record is 16 bytes, little endian:
+#     u32     ticks_us() at the start of the transaction
+#     u32     command word - the first four bytes written (see make_cmd in cyw.py)
+#     u32     first data word - written data for a write, data read (after any backplane padding)
+#             for a read, up to four bytes, zero filled
+#     u16     bytes written after the command word
+#     u16     bytes read, including any backplane padding
+# The command and data bytes are copied into the record as they are, one by one, and only
+# tools/trace_replay.py puts them together as words - on MicroPython a command word (bit 30 is always
+# set) would be a long int, allocated for every transaction.
+#
+# save() writes a header then the records, oldest first:
+#     4s      TRACE_MAGIC
+#     u8      TRACE_VERSION
+#     u8      RECORD_SIZE
+#     u16     0
+#     u32     number of records in the file
+#     u32     number of older records that were overwritten
+#
+# tools/trace_replay.py decodes the file on a host and summarises it.
+# Transactions before the gSPI configuration is written are 16 bit word swapped and are recorded
+# as they were sent.
+
+import struct
+from time import ticks_us
+from gspi import Transport
+
+TRACE_MAGIC   = b'GSPT'
+TRACE_VERSION = 1
+
+HEADER_FORMAT = '<4sBBHII'
+RECORD_FORMAT = '<IIIHH'
+RECORD_SIZE   = 16
+TICKS_MASK    = 0x3fff_ffff          # ticks_us() wraps at 2**30, so this stays a small int
+
+BACK_FUNC     = 1                    # as in cyw.py - backplane reads start with 4 bytes of padding
+BACKPLANE_PAD = 4
+
+
+# Copy up to four bytes of buf[start:end] into dest at offset, zero filled
+def copy_word(dest, offset, buf, start, end):
+    for i in range(0, 4):
+        dest[offset + i] = buf[start + i] if start + i < end else 0
+
+
+class TraceTransport(Transport):
+    def __init__(self, inner, size=1024):
+        self.inner = inner
+        self.size = size
+        self.buf = bytearray(size * RECORD_SIZE)
+        self.count = 0
+        self.high_speed = inner.high_speed
+
+    # Anything else (cs, data_pin, sm...) comes from the wrapped transport
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def start(self):
+        self.inner.start()
+
+    def set_high_speed(self, high_speed):
+        self.inner.set_high_speed(high_speed)
+        self.high_speed = high_speed
+
+    def irq_pin(self):
+        return self.inner.irq_pin()
+
+    def set_irq(self, handler):
+        self.inner.set_irq(handler)
+
+    def write_readinto(self, write, read):
+        start = ticks_us()
+        self.inner.write_readinto(write, read)
+
+        write_length = len(write)
+        read_length = len(read) if read else 0
+        buf = self.buf
+        offset = (self.count % self.size) * RECORD_SIZE
+        copy_word(buf, offset + 4, write, 0, write_length)
+        if write_length > 4:
+            copy_word(buf, offset + 8, write, 4, write_length)
+        elif read_length > 0:
+            pad = BACKPLANE_PAD if (write[3] >> 4) & 3 == BACK_FUNC else 0
+            copy_word(buf, offset + 8, read, pad, read_length)
+        else:
+            copy_word(buf, offset + 8, write, 0, 0)
+        struct.pack_into('<I', buf, offset, start & TICKS_MASK)
+        struct.pack_into('<HH', buf, offset + 12, max(write_length - 4, 0), read_length)
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    # The records, oldest first
+    def records(self):
+        if self.count <= self.size:
+            return self.buf[0:self.count * RECORD_SIZE]
+        split = (self.count % self.size) * RECORD_SIZE
+        return self.buf[split:] + self.buf[0:split]
+
+    def save(self, name="trace.bin"):
+        recorded = min(self.count, self.size)
+        with open(name, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, RECORD_SIZE, 0,
+                                recorded, self.count - recorded))
+            f.write(self.records())
+        print("---- Trace: {} transactions saved to {}".format(recorded, name))
+        return recorded
@@ -0,0 +1,58 @@
+# Leveled logging for the HCI layers
+#
+# Each subsystem has its own level, and a message is only formatted and printed if its level is at
+# or below the subsystem's level:
+#
+#     log(HCI, DEBUG, "Event: LE Meta event: {:#x}", subevent_code)
+#     dump(TRANSPORT, TRACE, "\n>> Data received: ", data)
+#
+# The arguments are passed as they are and only formatted when the message is printed, so a disabled
+# message allocates nothing - pass ints and buffers, not strings built at the call site.
+# Anything that needs work just to find what to print goes under enabled():
+#
+#     if enabled(SCAN, DEBUG):
+#         ...
+#
+# The default is INFO for everything. verbose() turns everything up to TRACE, which prints all
+# that the driver used to print, and quiet() turns everything off.
+
+TRANSPORT = 0
+HCI       = 1
+ACL       = 2
+ATT       = 3
+SCAN      = 4
+
+SUBSYSTEMS = ("transport", "hci", "acl", "att", "scan")
+
+OFF   = 0
+ERROR = 1
+INFO  = 2
+DEBUG = 3
+TRACE = 4
+
+levels = bytearray([INFO] * len(SUBSYSTEMS))
+
+
+def set_level(level, subsystem=None):
+    if subsystem is None:
+        for i in range(0, len(levels)):
+            levels[i] = level
+    else:
+        levels[subsystem] = level
+
+def verbose():
+    set_level(TRACE)
+
+def quiet():
+    set_level(OFF)
+
+def enabled(subsystem, level):
+    return levels[subsystem] >= level
+
+def log(subsystem, level, msg, a=None, b=None, c=None, d=None):
+    if levels[subsystem] >= level:
+        print(msg.format(a, b, c, d))
+
+def dump(subsystem, level, title, data):
+    if levels[subsystem] >= level:
+        print(title, ' '.join('{:02x}'.format(b) for b in data))
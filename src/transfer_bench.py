@@ -0,0 +1,26 @@
+# gSPI transfer benchmark
+#
+# Times FEEDBEAD register reads through the transport in use, to compare transports:
+#
+#     cyw = CYW(PIOTransport())
+#     import transfer_bench
+#     transfer_bench.run()
+#
+# The bus must already be set up, by CYW() or BluetoothLEConnection().
+
+from time import ticks_us, ticks_diff
+import cyw
+
+
+# Returns the average microseconds per transaction
+def time_transfers(count=100):
+    start = ticks_us()
+    for i in range(0, count):
+        cyw.cyw_read_reg_u32(cyw.SPI_FUNC, cyw.FEEDBEAD_REG)
+    return ticks_diff(ticks_us(), start) // count
+
+
+def run(count=100):
+    us = time_transfers(count)
+    print("---- {}: {} us per register read".format(cyw.transport.__class__.__name__, us))
+    return us
@@ -0,0 +1,117 @@
+# Convert the raw bluetooth firmware file (btfw.bin) into a flat image (btfw.img)
+#
+# Runs on the host, not the Pico:
+#     python btfw_convert.py btfw.bin btfw.img
+#
+# The raw file is a list of small records (see write_bt_firmware_records() in cyw.py) which the
+# Pico would otherwise parse on every boot. Here the records are parsed once, contiguous data
+# records are merged into segments, and each segment is padded to whole 32 bit words.
+# write_bt_firmware() in cyw.py streams the image straight into backplane writes.
+#
+# Image format (all values little endian):
+#   4 bytes     Magic - 00 'B' 'T' 'I'
+#   1 byte      Number of bytes in version string
+#   n bytes     Version string
+#   4 bytes     Number of segments
+#       4 bytes     Address (offset from BTFW_MEM_OFFSET)
+#       4 bytes     Length, a multiple of 4
+#       n bytes     Data
+
+import struct
+import sys
+
+BTFW_IMAGE_MAGIC = b'\x00BTI'
+
+TYPE_DATA = 0
+TYPE_END_OF_DATA = 1
+TYPE_EXTENDED_ADDRESS = 4
+
+
+# Parse the raw file into the version string and a list of (address, data) records
+
+def read_records(raw):
+    ver_len = raw[0]
+    ver = raw[1:1 + ver_len]
+    ind = 1 + ver_len
+    num_recs = raw[ind]
+    ind += 1
+
+    addr_high = 0
+    records = []
+    for i in range(0, num_recs):
+        block_len = raw[ind]
+        addr_low  = (raw[ind + 1] << 8) | raw[ind + 2]
+        rec_type  = raw[ind + 3]
+        data = raw[ind + 4:ind + 4 + block_len]
+        ind += 4 + block_len
+
+        if rec_type == TYPE_EXTENDED_ADDRESS:
+            addr_high = (data[0] << 24) | (data[1] << 16)
+        elif rec_type == TYPE_DATA:
+            records.append((addr_high + addr_low, data))
+        elif rec_type == TYPE_END_OF_DATA:
+            break
+        else:
+            raise ValueError("Unsupported record type {}".format(rec_type))
+    return ver, records
+
+
+# Merge contiguous records into segments, then word align each segment
+
+def make_segments(records):
+    segments = []
+    for addr, data in records:
+        if segments and segments[-1][0] + len(segments[-1][1]) == addr:
+            segments[-1][1] += data
+        else:
+            segments.append([addr, bytearray(data)])
+
+    aligned = []
+    for addr, data in segments:
+        if addr & 3:
+            # backplane writes are whole words, so start on a word boundary
+            print("Warning: segment at 0x{:08x} is not word aligned, padding the start".format(addr))
+            data = bytearray(addr & 3) + data
+            addr &= ~3
+        data += bytes(-len(data) & 3)
+        aligned.append((addr, bytes(data)))
+
+    # the padding must not run into another segment
+    ordered = sorted(aligned)
+    for i in range(1, len(ordered)):
+        if ordered[i - 1][0] + len(ordered[i - 1][1]) > ordered[i][0]:
+            raise ValueError("Segment at 0x{:08x} overlaps another".format(ordered[i][0]))
+    return aligned
+
+
+def make_image(raw):
+    ver, records = read_records(raw)
+    segments = make_segments(records)
+
+    image = bytearray(BTFW_IMAGE_MAGIC)
+    image += bytes([len(ver)]) + ver
+    image += struct.pack('<I', len(segments))
+    for addr, data in segments:
+        image += struct.pack('<II', addr, len(data)) + data
+    return ver, segments, bytes(image)
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("Usage: btfw_convert.py btfw.bin btfw.img")
+        return 1
+    with open(argv[1], 'rb') as f:
+        raw = f.read()
+    ver, segments, image = make_image(raw)
+    with open(argv[2], 'wb') as f:
+        f.write(image)
+
+    print("Version:  {}".format(ver.decode('ascii', 'replace')))
+    for addr, data in segments:
+        print("Segment:  0x{:08x} {:6} bytes".format(addr, len(data)))
+    print("Image:    {} bytes from {} raw".format(len(image), len(raw)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
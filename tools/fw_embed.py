@@ -0,0 +1,67 @@
+# Generate a python module holding the CYW43439 firmware as bytes constants
+#
+# Runs on the host, not the Pico:
+#     python fw_embed.py ../fw cyw_fw.py
+#
+# The module has three constants:
+#     FW        WLAN firmware, with the CLM removed
+#     NVRAM     NVRAM settings
+#     BTFW      bluetooth firmware, as the flat image from btfw_convert.py
+#
+# Freeze it into the MicroPython build (add module("cyw_fw.py") to the board manifest) so the bytes
+# stay in flash rather than RAM, then pass it to the driver:
+#     import cyw_fw
+#     ble = BLE(1, firmware=cyw_fw)
+#
+# The firmware is then written straight from flash, with no file system reads.
+
+import os
+import sys
+
+from btfw_convert import BTFW_IMAGE_MAGIC, make_image
+
+CYW43_CLM_LEN = 984           # fw.bin ends with the CLM, which is not needed for bluetooth
+
+LINE_BYTES = 32
+
+
+def bytes_constant(name, data):
+    lines = ["{} = (".format(name)]
+    for i in range(0, len(data), LINE_BYTES):
+        chunk = data[i:i + LINE_BYTES]
+        lines.append("    b'" + ''.join('\\x{:02x}'.format(b) for b in chunk) + "'")
+    lines.append(")")
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("Usage: fw_embed.py firmware_directory output.py")
+        return 1
+    fw_dir = argv[1]
+
+    with open(os.path.join(fw_dir, 'fw.bin'), 'rb') as f:
+        fw = f.read()[:-CYW43_CLM_LEN]
+    with open(os.path.join(fw_dir, 'nvram.bin'), 'rb') as f:
+        nvram = f.read()
+    with open(os.path.join(fw_dir, 'btfw.bin'), 'rb') as f:
+        btfw = f.read()
+    if not btfw.startswith(BTFW_IMAGE_MAGIC):
+        ver, segments, btfw = make_image(btfw)
+
+    with open(argv[2], 'w') as f:
+        f.write("# CYW43439 firmware - generated by tools/fw_embed.py, do not edit\n\n")
+        f.write(bytes_constant("FW", fw))
+        f.write("\n")
+        f.write(bytes_constant("NVRAM", nvram))
+        f.write("\n")
+        f.write(bytes_constant("BTFW", btfw))
+
+    print("FW:      {} bytes".format(len(fw)))
+    print("NVRAM:   {} bytes".format(len(nvram)))
+    print("BTFW:    {} bytes".format(len(btfw)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,167 @@
+# Replay a gSPI trace (trace.bin, from gspi_trace.py) and summarise the bus traffic
+#
+# Runs on the host, not the Pico:
+#     python trace_replay.py trace.bin [top]
+#
+# Each recorded transaction is decoded (see make_cmd in cyw.py) and replayed against a stand-in
+# device. The device follows the backplane window writes, so backplane accesses are shown at their
+# full address, and keeps the last value written to each address and read from it.
+# The summary gives counts per function and per address, with
+#     same     writes of the value that address already held, and reads that returned the same value
+#              as the last read with no write in between - candidates for caching or removal
+#
+# Only the first data word of each transaction is recorded, so values are only complete for
+# register accesses of up to four bytes.
+
+import struct
+import sys
+
+TRACE_MAGIC   = b'GSPT'
+HEADER_FORMAT = '<4sBBHII'
+RECORD_FORMAT = '<IIIHH'
+
+TICKS_PERIOD  = 1 << 30              # MicroPython ticks_us() wraps at 2^30
+
+SPI_FUNC  = 0
+BACK_FUNC = 1
+WLAN_FUNC = 2
+FUNC_NAMES = ["SPI", "BACKPLANE", "WLAN", "FUNC3"]
+
+BACKPLANE_LOW_REG  = 0x1_000a
+BACKPLANE_HIGH_REG = 0x1_000c
+
+REG_NAMES = {
+    (SPI_FUNC,  0x00):        "CONFIG_REG",
+    (SPI_FUNC,  0x04):        "SPI_INT_REG",
+    (SPI_FUNC,  0x06):        "SPI_INT_ENABLE_REG",
+    (SPI_FUNC,  0x08):        "SPI_STATUS_REG",
+    (SPI_FUNC,  0x14):        "FEEDBEAD_REG",
+    (SPI_FUNC,  0x18):        "TEST_REG",
+    (SPI_FUNC,  0x1d):        "BACKPLANE_PAD_REG",
+    (BACK_FUNC, 0x1_0008):    "SDIO_FUNCTION2_WATERMARK",
+    (BACK_FUNC, 0x1_000a):    "BACKPLANE_LOW_REG",
+    (BACK_FUNC, 0x1_000b):    "BACKPLANE_MED_REG",
+    (BACK_FUNC, 0x1_000c):    "BACKPLANE_HIGH_REG",
+    (BACK_FUNC, 0x1_000e):    "SDIO_CHIP_CLOCK_CSR",
+    (BACK_FUNC, 0x1_000f):    "SDIO_PULL_UP",
+    (BACK_FUNC, 0x1800_0d68): "WLAN_BASE_ADDRESS_REG",
+    (BACK_FUNC, 0x1800_0d6c): "HOST_CONTROL_REG",
+    (BACK_FUNC, 0x1800_0c7c): "BT_CONTROL_REG",
+    (BACK_FUNC, 0x1800_2020): "SDIO_INT_STATUS",
+    (BACK_FUNC, 0x1800_2024): "SDIO_INT_HOST_MASK",
+}
+
+
+def decode_cmd(cmd):
+    wr   = (cmd >> 31) & 1
+    inc  = (cmd >> 30) & 1
+    fn   = (cmd >> 28) & 3
+    addr = (cmd >> 11) & 0x1_ffff
+    size = cmd & 0x3ff
+    return wr, inc, fn, addr, size
+
+
+def read_trace(data):
+    magic, version, record_size, _, count, dropped = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != TRACE_MAGIC:
+        raise ValueError("not a gSPI trace file")
+    offset = struct.calcsize(HEADER_FORMAT)
+    records = []
+    for i in range(0, count):
+        records.append(struct.unpack_from(RECORD_FORMAT, data, offset + i * record_size))
+    return records, dropped
+
+
+# Stand-in device - just enough of the chip to make sense of the addresses
+
+class StandInDevice:
+    def __init__(self):
+        self.window = 0
+        self.values = {}
+        self.last_read = {}
+
+    def address(self, fn, addr):
+        if fn == BACK_FUNC and addr < 0x1_0000:
+            return self.window | (addr & 0x7fff)
+        return addr
+
+    # Returns True if the transaction repeats what the device already had
+    def transaction(self, wr, fn, addr, size, data):
+        full = self.address(fn, addr)
+        key = (fn, full)
+        size = min(size, 4)
+        mask = (1 << (size * 8)) - 1 if size else 0xffff_ffff
+        data &= mask
+        if wr:
+            if fn == BACK_FUNC and BACKPLANE_LOW_REG <= addr <= BACKPLANE_HIGH_REG:
+                for i in range(0, size):
+                    shift = (addr + i - BACKPLANE_LOW_REG + 1) * 8
+                    if shift <= 24:
+                        byte = (data >> (i * 8)) & 0xff
+                        self.window = (self.window & ~(0xff << shift)) | (byte << shift)
+            same = self.values.get(key) == data
+            self.values[key] = data
+            self.last_read.pop(key, None)
+        else:
+            same = self.last_read.get(key) == data
+            self.last_read[key] = data
+        return key, same
+
+
+def replay(records, device):
+    functions = {}
+    addresses = {}
+    for ts, cmd, data, write_length, read_length in records:
+        wr, inc, fn, addr, size = decode_cmd(cmd)
+        key, same = device.transaction(wr, fn, addr, size, data)
+
+        f = functions.setdefault(fn, [0, 0, 0])
+        f[wr] += 1
+        f[2] += write_length if wr else read_length
+
+        a = addresses.setdefault(key, [0, 0, 0, 0])
+        a[wr] += 1
+        if same:
+            a[2 + wr] += 1
+    return functions, addresses
+
+
+def name_of(key):
+    fn, addr = key
+    name = REG_NAMES.get(key, "")
+    return "{:9} 0x{:08x} {}".format(FUNC_NAMES[fn], addr, name)
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print("Usage: trace_replay.py trace.bin [top]")
+        return 1
+    top = int(argv[2]) if len(argv) == 3 else 20
+    with open(argv[1], 'rb') as f:
+        records, dropped = read_trace(f.read())
+    if not records:
+        print("No transactions")
+        return 0
+
+    functions, addresses = replay(records, StandInDevice())
+
+    span = (records[-1][0] - records[0][0]) % TICKS_PERIOD
+    print("Transactions: {} over {} ms ({} older ones overwritten)".format(len(records), span // 1000, dropped))
+    print()
+    print("Function     reads  writes     bytes")
+    for fn in sorted(functions):
+        reads, writes, byts = functions[fn]
+        print("{:9} {:8} {:7} {:9}".format(FUNC_NAMES[fn], reads, writes, byts))
+    print()
+    print("Address                                           reads  same  writes  same")
+    ranked = sorted(addresses.items(), key=lambda item: -(item[1][0] + item[1][1]))
+    for key, (reads, writes, same_reads, same_writes) in ranked[0:top]:
+        print("{:48} {:6} {:5} {:7} {:5}".format(name_of(key), reads, same_reads, writes, same_writes))
+    redundant = sum(a[2] + a[3] for a in addresses.values())
+    print()
+    print("Repeated reads and writes: {} of {}".format(redundant, len(records)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))